@@ -0,0 +1,99 @@
+import timeit
+import argparse
+import numpy as np
+from thala2.bbox.boundingbox import alpha_brend
+
+
+def alpha_brend_legacy(dst, src, *, left=0, top=0):
+    h1, w1, a1 = dst.shape
+    h2, w2, a2 = src.shape
+    h = min(h1 - top, h2)
+    w = min(w1 - left, w2)
+    if a2 == 3:
+        dst[top:top + h, left:left + w, :3] = src[:h, :w, :3]
+        if a1 == 4:
+            dst[top:top + h, left:left + w, 3] = 255
+    else:
+        mask = src[:h, :w, 3] / 255
+        for i in range(3):
+            dst[top:top + h, left:left + w, i] = (dst[top:top + h, left:left + w, i] * (1 - mask) +
+                                                  src[:h, :w, i] * mask).astype(np.uint8)
+        if a1 == 4:
+            dst[top:top + h, left:left + w, 3] = ((1 - (1 - dst[top:top + h, left:left + w, 3] / 255)
+                                                   * (1 - mask)) * 255).astype(np.uint8)
+
+    return dst
+
+
+def make_layers(width, height, rng):
+    opaque = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    opaque[:, :, 3] = 255
+
+    translucent = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+
+    # a subtitle line: transparent except a band at the bottom
+    subtitle = np.zeros((height, width, 4), dtype=np.uint8)
+    band = subtitle[height * 4 // 5:height * 9 // 10, width // 8:width * 7 // 8]
+    band[:] = rng.integers(0, 256, band.shape, dtype=np.uint8)
+
+    return {
+        "opaque": opaque,
+        "translucent": translucent,
+        "subtitle": subtitle,
+    }
+
+
+def nested(dst, layers, canvases, blend):
+    """
+    layers overlapping in one transparent canvas, which is blended through
+    canvases more transparent canvases into dst, as a tree renders them
+    """
+    canvas = np.zeros_like(dst)
+    for layer in layers:
+        blend(canvas, layer)
+    if blend is alpha_brend:
+        return alpha_brend(dst, canvas, canvases=canvases)
+
+    for _ in range(canvases):
+        canvas = alpha_brend_legacy(np.zeros_like(dst), canvas)
+    return alpha_brend_legacy(dst, canvas)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--number", type=int, default=20)
+parser.add_argument("--depth", type=int, default=4)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+print(f"{'size':>10} {'layer':>12} {'legacy[ms]':>11} {'kernel[ms]':>11} {'speedup':>8}")
+for (width, height) in ((960, 540), (1920, 1080)):
+    dst = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    for (name, src) in make_layers(width, height, rng).items():
+        expected = alpha_brend_legacy(dst.copy(), src)
+        actual = alpha_brend(dst.copy(), src)
+        assert np.abs(expected.astype(int) - actual).max() <= 1
+
+        work = dst.copy()
+        legacy = min(timeit.repeat(lambda: alpha_brend_legacy(work, src),
+                                   number=args.number, repeat=3)) / args.number
+        kernel = min(timeit.repeat(lambda: alpha_brend(work, src),
+                                   number=args.number, repeat=3)) / args.number
+        print(f"{width:>5}x{height:<4} {name:>12} {legacy * 1e3:>11.2f} "
+              f"{kernel * 1e3:>11.2f} {legacy / kernel:>7.1f}x")
+
+# every blend of the legacy kernel rounds down once, so the results drift
+# apart by one per blend, and alpha by one more
+print(f"{'size':>10} {'canvases':>8} {'color diff':>11} {'alpha diff':>11}")
+for (width, height) in ((960, 540), (1920, 1080)):
+    dst = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    layers = make_layers(width, height, rng)
+    layers = [layers["translucent"], layers["subtitle"]]
+    for canvases in range(args.depth + 1):
+        expected = nested(dst.copy(), layers, canvases, alpha_brend_legacy)
+        actual = nested(dst.copy(), layers, canvases, alpha_brend)
+        diff = np.abs(expected.astype(int) - actual)
+        color = diff[:, :, :3].max()
+        alpha = diff[:, :, 3].max()
+        assert color <= len(layers) + canvases
+        assert alpha <= len(layers) + canvases + 1
+        print(f"{width:>5}x{height:<4} {canvases:>8} {color:>11} {alpha:>11}")
@@ -0,0 +1,60 @@
+import time
+import argparse
+import numpy as np
+import pydub
+from thala2.track import SegmentTrack, ParTrack
+
+
+def overlay_legacy(segments):
+    # the same folding as Audio._build_par before the track graph
+    audio = None
+    for next in segments:
+        if audio:
+            if audio.duration_seconds < next.duration_seconds:
+                audio = next.overlay(audio)
+            else:
+                audio = audio.overlay(next)
+        else:
+            audio = next
+    return audio
+
+
+def make_segments(count, seconds, rng):
+    segments = []
+    for i in range(count):
+        # quiet enough not to saturate, so both mixers agree exactly
+        frames = int(44100 * seconds * (1 - i / (2 * count)))
+        samples = rng.integers(-512, 512, (frames, 2), dtype=np.int16)
+        segments.append(pydub.AudioSegment(data=samples.tobytes(),
+                                           sample_width=2, frame_rate=44100,
+                                           channels=2))
+    return segments
+
+
+def measure(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return (best, result)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--seconds", type=float, default=60)
+parser.add_argument("--repeat", type=int, default=3)
+args = parser.parse_args()
+
+rng = np.random.default_rng(0)
+print(f"{'tracks':>6} {'legacy[s]':>10} {'track[s]':>10} {'speedup':>8}")
+for count in (2, 8, 32):
+    segments = make_segments(count, args.seconds, rng)
+
+    (legacy, expected) = measure(lambda: overlay_legacy(segments).raw_data,
+                                 args.repeat)
+    (track, actual) = measure(
+        lambda: ParTrack([SegmentTrack(s) for s in segments]).raw_data,
+        args.repeat)
+    assert expected == actual
+
+    print(f"{count:>6} {legacy:>10.3f} {track:>10.3f} {legacy / track:>7.1f}x")
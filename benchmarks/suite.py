@@ -0,0 +1,268 @@
+import io
+import os
+import sys
+import json
+import time
+import wave
+import argparse
+import subprocess
+import numpy as np
+import cv2
+import xml.etree.ElementTree as ET
+from moviepy.config import get_setting
+import thala2
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        "baseline.json")
+METRICS = ("build", "frame", "audio", "rss")
+
+
+class ToneTTS(thala2.TTS):
+    """
+    offline speech: a tone which gets longer with the text
+    """
+
+    def text_to_speech(self, text: str):
+        rate = 24000
+        samples = np.arange(int(rate * (0.3 + 0.05 * len(text))))
+        tone = np.sin(2 * np.pi * (200 + len(text) % 50 * 4) * samples / rate)
+
+        data = io.BytesIO()
+        with wave.open(data, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(rate)
+            f.writeframes((tone * 6000).astype(np.int16).tobytes())
+        return (data.getvalue(), "wav")
+
+
+def make_media(directory, seconds=10):
+    """
+    synthetic movie with sound, opaque and translucent images and a tone
+    """
+    os.makedirs(directory, exist_ok=True)
+    media = {name: os.path.join(directory, name) for name in
+             ("movie.mp4", "opaque.png", "translucent.png", "tone.wav")}
+
+    if not os.path.exists(media["movie.mp4"]):
+        subprocess.run([get_setting("FFMPEG_BINARY"), "-y",
+                        "-loglevel", "error",
+                        "-f", "lavfi", "-i", "testsrc2=size=720x1280:rate=30",
+                        "-f", "lavfi", "-i", "sine=frequency=440",
+                        "-t", str(seconds), "-c:v", "libx264",
+                        "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+                        "-c:a", "aac", media["movie.mp4"]], check=True)
+
+    rng = np.random.default_rng(0)
+    if not os.path.exists(media["opaque.png"]):
+        img = rng.integers(0, 256, (540, 960, 3), dtype=np.uint8)
+        cv2.imwrite(media["opaque.png"], cv2.GaussianBlur(img, (31, 31), 0))
+    if not os.path.exists(media["translucent.png"]):
+        img = np.zeros((540, 960, 4), dtype=np.uint8)
+        img[:, :, :3] = rng.integers(0, 256, (540, 960, 3), dtype=np.uint8)
+        img[:, :, 3] = np.linspace(0, 255, 960, dtype=np.uint8)[None, :]
+        cv2.imwrite(media["translucent.png"], img)
+    if not os.path.exists(media["tone.wav"]):
+        with wave.open(media["tone.wav"], "wb") as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(44100)
+            tone = np.sin(2 * np.pi * 330 * np.arange(44100 * 2) / 44100)
+            f.writeframes(np.repeat((tone * 8000).astype(np.int16), 2))
+
+    return media
+
+
+def clip(media, t0, t1, ft=1):
+    return f"""
+<scale ft="{ft}">
+    <crop x0="0" x1="270" y0="30" y1="510" t0="{t0}s" t1="{t1}s">
+        <scale fxy="0.375" soundLevel="-15dB">
+            <media width="720" height="1280">
+                <movie src="{media['movie.mp4']}"/>
+            </media>
+        </scale>
+    </crop>
+</scale>"""
+
+
+def subtitle(text, duration):
+    return f"""
+<margin top="400" left="300">
+    <media width="600" height="100" duration="{duration}s">
+        <speak>{text}</speak>
+    </media>
+</margin>"""
+
+
+def screen(media, body):
+    return f"""
+<media width="960" height="540">
+    <par>
+        <image src="{media['opaque.png']}" duration="0s"/>
+        {body}
+        <scale soundLevel="-6dB"><audio src="{media['tone.wav']}"/></scale>
+    </par>
+</media>"""
+
+
+def deep(media, size):
+    body = clip(media, 0, 5)
+    for i in range(size):
+        body = f"""
+<margin left="{i % 3}" top="{i % 2}">
+    <crop x1="{900 - i}" y1="{520 - i}">{body}</crop>
+</margin>"""
+    return screen(media, body)
+
+
+def wide(media, size):
+    return screen(media, "".join(
+        f"""<margin left="{i * 90 % 700}" top="{i * 37 % 60}">
+                {clip(media, i * 0.1, i * 0.1 + 5)}
+            </margin>""" for i in range(size)))
+
+
+def long(media, size):
+    return screen(media, "<seq>" + "".join(
+        f"<par>{clip(media, i % 5, i % 5 + 0.5)}"
+        f"{subtitle(f'segment {i}', 0.5)}</par>"
+        for i in range(size)) + "</seq>")
+
+
+def subtitles(media, size):
+    return screen(media, f"""
+<image src="{media['translucent.png']}" duration="0s"/>
+<seq>{"".join(subtitle(f"subtitle line number {i} " * (1 + i % 3), 0.4)
+              for i in range(size))}</seq>""")
+
+
+def fast(media, size):
+    return screen(media, "<seq>" + "".join(
+        clip(media, 0, 8, 1 / (i + 2)) for i in range(size)) + "</seq>")
+
+
+CASES = {
+    "deep": (deep, 16),
+    "wide": (wide, 8),
+    "long": (long, 12),
+    "subtitles": (subtitles, 16),
+    "fast": (fast, 4),
+}
+
+
+def peak_rss():
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes except on macOS
+    return rss / 2 ** 20 if sys.platform == "darwin" else rss / 2 ** 10
+
+
+def run(case, size, media, args):
+    """
+    metrics of one document, measured in a fresh process
+    """
+    elem = ET.fromstring(CASES[case][0](media, size))
+    video_maker = thala2.Video(fontPath=args.font, fontSize=40,
+                               audio=thala2.Audio(tts=ToneTTS()))
+
+    start = time.perf_counter()
+    (video, audio) = video_maker.build(elem)
+    build = time.perf_counter() - start
+
+    (_, _, duration) = video.boundings()
+    times = np.arange(0, duration, 1 / args.fps)
+    start = time.perf_counter()
+    for t in times:
+        video.image(t)
+    frame = (time.perf_counter() - start) / max(len(times), 1)
+
+    start = time.perf_counter()
+    for _ in audio.raw_blocks():
+        pass
+    mix = time.perf_counter() - start
+
+    return {"build": build * 1e3, "frame": frame * 1e3, "audio": mix * 1e3,
+            "rss": peak_rss()}
+
+
+def measure(case, size, args):
+    # the best of several processes, so that peak RSS is of the case alone
+    results = []
+    for _ in range(args.repeat):
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--case", case,
+             "--size", str(size), "--media", args.media, "--fps",
+             str(args.fps), "--font", args.font],
+            stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(process.stdout))
+    return {metric: min(result[metric] for result in results)
+            for metric in METRICS}
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--font", required=True,
+                    help="font file for the subtitles; none is bundled, and "
+                    "the platform default may not exist")
+parser.add_argument("--media", default=os.path.join(
+    os.path.expanduser("~"), ".cache", "thala2", "benchmarks"))
+parser.add_argument("--fps", type=float, default=30)
+parser.add_argument("--repeat", type=int, default=3)
+parser.add_argument("--cases", nargs="*", default=list(CASES))
+parser.add_argument("--baseline", default=BASELINE)
+parser.add_argument("--update", action="store_true",
+                    help="store the results as the baseline")
+parser.add_argument("--tolerance", type=float, default=0.2)
+parser.add_argument("--case", help=argparse.SUPPRESS)
+parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+args = parser.parse_args()
+if not os.path.isfile(args.font):
+    parser.error(f"--font {args.font} is not found.")
+
+if args.case:
+    print(json.dumps(run(args.case, args.size, make_media(args.media), args)))
+    sys.exit()
+
+make_media(args.media)
+baseline = {}
+if os.path.exists(args.baseline) and not args.update:
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+results = {}
+regressions = []
+print(f"{'case':>12}" + "".join(
+    f"{name:>18}" for name in ("build[ms]", "frame[ms]", "audio[ms]", "rss[MB]")))
+for case in args.cases:
+    (_, size) = CASES[case]
+    key = f"{case}-{size}"
+    results[key] = measure(case, size, args)
+
+    row = f"{key:>12}"
+    for metric in METRICS:
+        value = results[key][metric]
+        cell = f"{value:.1f}"
+        if key in baseline:
+            # compared with the baseline as a relative change
+            ratio = value / baseline[key][metric]
+            cell += f" ({ratio - 1:+.0%})"
+            if 1 + args.tolerance < ratio:
+                regressions.append(f"{key} {metric}: "
+                                   f"{baseline[key][metric]:.1f} -> "
+                                   f"{value:.1f}")
+        row += f"{cell:>18}"
+    print(row)
+
+if args.update:
+    with open(args.baseline, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=1)
+for regression in regressions:
+    print("regression", regression)
+sys.exit(1 if regressions else 0)
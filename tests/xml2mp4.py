@@ -1,16 +1,33 @@
 import thala2
-import xml.etree.ElementTree as ET
 from datetime import datetime as DT
 import argparse
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("xmlfile")
-parser.add_argument("--fps", type=float, default=30)
-args = parser.parse_args()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("xmlfile")
+    parser.add_argument("--fps", type=float, default=30)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--preset", default="medium")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--draft", type=float, default=1.)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
 
-root = ET.parse(args.xmlfile).getroot()
+    (root, lines) = thala2.parse(args.xmlfile)
+    profiler = thala2.Profiler(lines=lines) if args.profile else None
 
-clip = thala2.Video(colorBGR=(0, 0, 0, 255)).encode(root)
-clip.write_videofile(args.xmlfile+".mp4", fps=args.fps, verbose=False, logger=None)
+    with thala2.MediaPool() as pool:
+        # a draft is also rendered at draft times the frame rate
+        thala2.Video(colorBGR=(0, 0, 0, 255), draft=args.draft,
+                     pool=pool, profiler=profiler).write(
+            root, args.xmlfile+".mp4", fps=args.fps * args.draft,
+            processes=args.processes,
+            preset=args.preset, threads=args.threads, workdir=args.workdir)
+
+    if profiler:
+        print(profiler.report(limit=30))
+        profiler.save(args.xmlfile+".profile.json")
+        profiler.save_trace(args.xmlfile+".trace.json")
 
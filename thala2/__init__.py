@@ -1,7 +1,12 @@
 from .audio import Audio
 from .video import Video
+from .pool import MediaPool
+from .proxy import ProxyCache
+from .profiler import Profiler, parse
+from .writer import FFmpegWriter
 from .tts import *
 from .bbox import *
+from .track import *
 
 
 __version__ = "20220416"
@@ -1,36 +1,50 @@
 import pydub
 import io
-import base64
-from .tts import VoiceVoxTTS, GoogleTTS
+import os
+import copy
+import json
+import hashlib
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from .tts import VoiceVoxTTS, GoogleTTS, CachedTTS
+from .pool import MediaPool
+from .track import *
+from .track.track import conform
 from .util import parse_time, parse_gain, ALL_ELEMENTS
-import requests
-import regex
-
-
-def speedup(audio, ft):
-    return pydub.AudioSegment(
-        data=audio.raw_data,
-        sample_width=audio.sample_width,
-        frame_rate=int(audio.frame_rate / ft),
-        channels=audio.channels)
 
 
 class Audio:
-    def __init__(self, *, tts=None):
+    def __init__(self, *, tts=None, pool=None, concurrency=4, batch_size=4,
+                 frame_rate=44100, channels=2, sample_width=2, cache=None,
+                 profiler=None):
         super().__init__()
+        assert 0 < concurrency, "0 < concurrency is needed."
+        assert 0 < batch_size, "0 < batch_size is needed."
+        assert channels in (1, 2), "1 or 2 channels are needed."
+
+        # every leaf is converted into this format once when it is loaded,
+        # and every node works in it
+        self.format = (frame_rate, channels, sample_width)
+
+        self.__pool = pool or MediaPool()
+        self.__cache = cache
+        self.__profiler = profiler
+        self.__memo = {}
+        self.__speech = {}
+        self.__concurrency = concurrency
+        self.__batch_size = batch_size
         if tts:
             self.__tts = tts
         else:
-            try:
-                res = requests.get("http://localhost:50021/docs")
-                if res.status_code == 200 and regex.search(
-                    "<title>VOICEVOX ENGINE - Swagger UI</title>",
-                        res.text):
-                    self.__tts = VoiceVoxTTS(host="http://localhost:50021")
-                else:
-                    self.__tts = GoogleTTS()
-            except requests.exceptions.ConnectionError:
+            if VoiceVoxTTS.is_running("http://localhost:50021"):
+                self.__tts = VoiceVoxTTS(host="http://localhost:50021")
+            else:
                 self.__tts = GoogleTTS()
+            self.__tts = CachedTTS(self.__tts)
+
+        if profiler:
+            profiler.observe("track", cache)
+            profiler.observe("tts", self.__tts)
 
     def _build_audio(self, elem):
         assert len(elem) == 0, "no child is needed."
@@ -40,7 +54,7 @@ class Audio:
         else:
             assert False, "src file is needed."
 
-        return pydub.AudioSegment.from_file(src)
+        return SegmentTrack(self.__pool.audio(src, self.format))
 
     def _build_image(self, elem):
         assert len(elem) == 0, "no child is needed."
@@ -50,9 +64,11 @@ class Audio:
         else:
             duration = 0.0
 
-        return pydub.AudioSegment.silent(duration * 1000)
+        (frame_rate, channels, sample_width) = self.format
+        return Track(frame_rate, channels, sample_width,
+                     int(frame_rate * duration))
 
-    def _build_speak(self, elem):
+    def _speak_text(self, elem):
         text = elem.text or ""
         for child in elem:
             if child.tag == "sub":
@@ -64,10 +80,18 @@ class Audio:
             else:
                 assert False, "child with sub-tag is needed."
 
-        (data, fmt) = self.__tts.text_to_speech(text)
+        return text
+
+    def _build_speak(self, elem):
+        text = self._speak_text(elem)
+
+        if text in self.__speech:
+            (data, fmt) = self.__speech[text]
+        else:
+            (data, fmt) = self.__tts.text_to_speech(text)
         audio = pydub.AudioSegment.from_file(io.BytesIO(data), format=fmt)
 
-        return audio
+        return SegmentTrack(conform(audio, *self.format))
 
     def _build_media(self, elem):
         assert len(elem) == 1, "only 1 child is needed."
@@ -79,13 +103,11 @@ class Audio:
             duration = parse_time(elem.attrib["duration"])
 
             if duration < audio.duration_seconds:
-                audio = speedup(audio,
-                                duration / audio.duration_seconds
-                                )
+                audio = StretchTrack(audio,
+                                     duration / audio.duration_seconds)
             elif audio.duration_seconds < duration:
-                audio = audio + \
-                    pydub.AudioSegment.silent(
-                        (duration - audio.duration_seconds) * 1000)
+                audio = MarginTrack(audio, 0, round(
+                    (duration - audio.duration_seconds) * audio.frame_rate))
 
         return audio
 
@@ -107,7 +129,8 @@ class Audio:
             t1 = audio.duration_seconds
 
         if 0 < t0 or t1 < audio.duration_seconds:
-            audio = audio[t0 * 1000:t1 * 1000]
+            audio = CropTrack(audio, round(t0 * audio.frame_rate),
+                              round(t1 * audio.frame_rate))
 
         return audio
 
@@ -128,10 +151,9 @@ class Audio:
         else:
             after = 0
 
-        if 0 < before:
-            audio = pydub.AudioSegment.silent(before * 1000) + audio
-        if 0 < after:
-            audio = audio + pydub.AudioSegment.silent(after * 1000)
+        if 0 < before or 0 < after:
+            audio = MarginTrack(audio, round(before * audio.frame_rate),
+                                round(after * audio.frame_rate))
 
         return audio
 
@@ -143,8 +165,8 @@ class Audio:
 
         if "soundLevel" in elem.attrib:
             soundLevel = parse_gain(elem.attrib["soundLevel"])
-
-            audio = audio.apply_gain(soundLevel)
+        else:
+            soundLevel = 0.
 
         if "ft" in elem.attrib:
             ft = float(elem.attrib["ft"])
@@ -154,31 +176,25 @@ class Audio:
         else:
             ft = 1
 
+        if soundLevel != 0:
+            audio = ScaleTrack(audio, gain=soundLevel)
         if ft != 1 and ft != 0:
-            audio = speedup(audio, ft)
+            audio = StretchTrack(audio, ft)
 
         return audio
 
     def _build_par(self, elem):
-        audio = None
+        tracks = []
 
         for child in elem:
             assert child.tag in ALL_ELEMENTS, f"child with {ALL_ELEMENTS}-tag is needed."
 
-            next = self._build_any(child)
-
-            if audio:
-                if audio.duration_seconds < next.duration_seconds:
-                    audio = next.overlay(audio)
-                else:
-                    audio = audio.overlay(next)
-            else:
-                audio = next
+            tracks.append(self._build_any(child))
 
-        return audio
+        return ParTrack(tracks)
 
     def _build_seq(self, elem):
-        audio = None
+        tracks = []
 
         for child in elem:
             assert child.tag in ALL_ELEMENTS, f"child with {ALL_ELEMENTS}-tag is needed."
@@ -186,31 +202,64 @@ class Audio:
             assert elem.tag in (
                 "media", "seq", "par", ), "child with media-tag / seq-tag / par-tag is needed."
 
-            next = self._build_any(child)
+            tracks.append(self._build_any(child))
+
+        return SeqTrack(tracks)
+
+    def key(self, elem):
+        """
+        stable hash of the subtree of elem and everything it is built from
+        """
+        node = copy.copy(elem)
+        node.tail = None
+
+        inputs = []
+        for e in elem.iter():
+            if "src" in e.attrib:
+                path = os.path.abspath(e.attrib["src"])
+                stat = os.stat(path)
+                inputs.append([path, stat.st_mtime_ns, stat.st_size])
+        if next(elem.iter("speak"), None) is not None:
+            inputs.append(list(self.__tts.identity()))
+
+        ident = [ET.canonicalize(ET.tostring(node, encoding="unicode")),
+                 list(self.format), inputs]
+        return hashlib.sha256(
+            json.dumps(ident, ensure_ascii=False).encode()).hexdigest()
+
+    def _storable(self, elem):
+        # only decoded and stretched samples are worth keeping; the other
+        # nodes are views on their children.
+        return elem.tag in ("audio", "movie", "speak") or \
+            (elem.tag == "media" and "duration" in elem.attrib) or \
+            (elem.tag == "scale" and ("ft" in elem.attrib or
+                                      "duration" in elem.attrib))
+
+    def _build_cached(self, elem):
+        if not self.__cache or not self._storable(elem):
+            return self._build_dummy(elem)
+
+        key = self.key(elem)
+        if audio := self.__cache.load(key, self.format):
+            return audio
 
-            if audio:
-                audio += next
-            else:
-                audio = next
+        audio = self._build_dummy(elem)
+        if isinstance(audio, (SegmentTrack, StretchTrack)):
+            audio = self.__cache.store(key, audio)
 
         return audio
 
     def _build_any(self, elem):
-        if ("raw_data" in elem.attrib and "sample_width" in elem.attrib and
-                "frame_rate" in elem.attrib and "channels" in elem.attrib):
-            return pydub.AudioSegment(
-                data=base64.b64decode(elem.attrib["raw_data"].encode()),
-                sample_width=int(elem.attrib["sample_width"]),
-                frame_rate=int(elem.attrib["frame_rate"]),
-                channels=int(elem.attrib["channels"])
-            )
+        # each node is consumed once by its parent, so its entry is dropped
+        # as soon as it is reused.
+        if elem in self.__memo:
+            return self.__memo.pop(elem)
         else:
-            audio = self._build_dummy(elem)
-
-            elem.attrib["raw_data"] = base64.b64encode(audio.raw_data).decode()
-            elem.attrib["sample_width"] = str(audio.sample_width)
-            elem.attrib["frame_rate"] = str(audio.frame_rate)
-            elem.attrib["channels"] = str(audio.channels)
+            if self.__profiler:
+                audio = self.__profiler.call(elem, self._build_cached, elem)
+            else:
+                audio = self._build_cached(elem)
+            self.__memo[elem] = audio
 
             return audio
 
@@ -238,5 +287,35 @@ class Audio:
         else:
             assert False
 
+    def prefetch(self, elem):
+        """
+        synthesize every speak-tag under elem concurrently
+        """
+        speaks = list(dict.fromkeys(
+            self._speak_text(speak) for speak in elem.iter("speak")))
+        texts = [text for text in speaks if text not in self.__speech]
+
+        # engines without a batch request synthesize one text per task
+        size = self.__batch_size if self.__tts.batched else 1
+        batches = [texts[i:i + size] for i in range(0, len(texts), size)]
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.__concurrency) as executor:
+            for (batch, speeches) in zip(batches, executor.map(
+                    self.__tts.texts_to_speech, batches)):
+                self.__speech.update(zip(batch, speeches))
+
+        return {text: self.__speech[text] for text in speaks}
+
+    def clear(self):
+        self.__memo.clear()
+        self.__speech.clear()
+
     def build(self, elem):
-        return self._build_any(elem)
+        if self.__profiler:
+            self.__profiler.document(elem)
+        self.prefetch(elem)
+        audio = self._build_any(elem)
+        self.clear()
+
+        return audio
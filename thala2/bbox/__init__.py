@@ -1 +1,3 @@
-from .boundingbox import BoundingBox, MovieBB, TextBB, ImageBB, CropBB, MarginBB, ScaleBB, ParBB, SeqBB
+from .boundingbox import TextCache, BoundingBox, MovieBB, TextBB, ImageBB, CropBB, MarginBB, ScaleBB, ParBB, SeqBB
+from .framesource import FrameSource
+from .merge import merge_crops
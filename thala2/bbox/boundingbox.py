@@ -1,10 +1,40 @@
 import io
+import math
+import bisect
+import itertools
 import cv2
 import numpy as np
 from PIL import Image, ImageDraw
+from .framesource import FrameSource
 
 
-def alpha_brend(dst, src, *, left=0, top=0):
+INF = float("inf")
+# margin against rounding when times are mapped between nodes
+EPSILON = 1e-9
+
+_SCRATCH = [np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint16)]
+
+
+def _scratch(i, shape):
+    size = int(np.prod(shape))
+    if _SCRATCH[i].size < size:
+        _SCRATCH[i] = np.empty(size, dtype=np.uint16)
+    return _SCRATCH[i][:size].reshape(shape)
+
+
+def _floor255(x, temp):
+    # floor(x / 255) for 0 <= x < 65535
+    np.right_shift(x, 8, out=temp)
+    x += temp
+    x += 1
+    x >>= 8
+
+
+def alpha_brend(dst, src, *, left=0, top=0, canvases=0):
+    """
+    blend src into dst, as if src were blended into the given number of
+    transparent canvases one after another first
+    """
     h1, w1, a1 = dst.shape
     h2, w2, a2 = src.shape
     h = min(h1 - top, h2)
@@ -15,18 +45,53 @@ def alpha_brend(dst, src, *, left=0, top=0):
     assert 0 <= w
     assert a1 in (3, 4)
     assert a2 in (3, 4)
-    if a2 == 3:
-        dst[top:top + h, left:left + w, :3] = src[:h, :w, :3]
-        if a1 == 4:
-            dst[top:top + h, left:left + w, 3] = 255
-    else:
-        mask = src[:h, :w, 3] / 255
-        for i in range(3):
-            dst[top:top + h, left:left + w, i] = (dst[top:top + h, left:left + w, i] * (1 - mask) +
-                                                  src[:h, :w, i] * mask).astype(np.uint8)
+
+    region = dst[top:top + h, left:left + w]
+    src = src[:h, :w]
+
+    if a2 == 3 or h == 0 or w == 0:
+        region[:, :, :3] = src[:, :, :3]
         if a1 == 4:
-            dst[top:top + h, left:left + w, 3] = ((1 - (1 - dst[top:top + h, left:left + w, 3] / 255)
-                                                   * (1 - mask)) * 255).astype(np.uint8)
+            region[:, :, 3] = 255
+        return dst
+
+    mask = cv2.extractChannel(src, 3)
+
+    # fully transparent rows and columns leave dst as it is
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return dst
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    region = region[y0:y1, x0:x1]
+    src = src[y0:y1, x0:x1, :a1]
+    mask = mask[y0:y1, x0:x1]
+
+    if mask.min() == 255:
+        region[:, :, :] = src
+        return dst
+
+    # every channel is dst * (255 - alpha) + src * alpha, divided by 255.
+    # alpha of dst is blended with 255 instead of alpha of src, which is
+    # the same as 255 - (255 - dst) * (255 - alpha) / 255 rounded down.
+    alpha = cv2.merge((mask, ) * a1)
+    color = _scratch(0, region.shape)
+    temp = _scratch(1, region.shape)
+
+    np.multiply(src, alpha, out=color, dtype=np.uint16)
+    for _ in range(canvases):
+        # a transparent canvas keeps alpha and turns color into
+        # color * alpha / 255
+        _floor255(color, temp)
+        color *= alpha
+    if a1 == 4:
+        np.multiply(mask, 255, out=color[:, :, 3], dtype=np.uint16)
+    np.bitwise_not(alpha, out=alpha)
+    np.multiply(region, alpha, out=temp, dtype=np.uint16)
+    color += temp
+    _floor255(color, temp)
+
+    region[:, :, :] = color
 
     return dst
 
@@ -56,26 +121,225 @@ def put_text(img, text, left, top, fontPIL, colorBGR):
     return img
 
 
+class TextCache:
+    def __init__(self):
+        self.rasters = {}
+        self.hits = 0
+        self.misses = 0
+
+    def raster(self, text, fontPIL, colorBGR):
+        key = (text, fontPIL, tuple(colorBGR))
+
+        if key in self.rasters:
+            self.hits += 1
+        else:
+            self.misses += 1
+            text_w, text_h = get_textbbox(text, fontPIL)
+            img = np.zeros([text_h, text_w, 4], dtype=np.uint8)
+            put_text(img, text, 0, 0, fontPIL, colorBGR)
+            img.flags.writeable = False
+            self.rasters[key] = img
+
+        return self.rasters[key]
+
+
+def shift_span(span, offset=0., scale=1.):
+    lo, hi = span
+    return (lo * scale + offset + EPSILON, hi * scale + offset - EPSILON)
+
+
+def clip_span(span, lo, hi):
+    return (max(span[0], lo), min(span[1], hi))
+
+
+def shift_range(rng, offset=0., scale=1.):
+    if rng is None:
+        return None
+    lo, hi = rng
+    return (lo * scale + offset - EPSILON, hi * scale + offset + EPSILON)
+
+
+def clip_range(rng, lo, hi):
+    if rng is None or rng[1] < lo or hi < rng[0]:
+        return None
+    return (max(rng[0], lo), min(rng[1], hi))
+
+
+def hull_range(rngs):
+    rngs = [rng for rng in rngs if rng is not None]
+    if not rngs:
+        return None
+    return (min(rng[0] for rng in rngs), max(rng[1] for rng in rngs))
+
+
+def shift_extent(ext, dx, dy):
+    if ext is None:
+        return None
+    x0, y0, x1, y1 = ext
+    return (x0 + dx, y0 + dy, x1 + dx, y1 + dy)
+
+
+def clip_extent(ext, width, height):
+    if ext is None:
+        return None
+    x0, y0, x1, y1 = ext
+    x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+
+def hull_extent(exts):
+    exts = [ext for ext in exts if ext is not None]
+    if not exts:
+        return None
+    return (min(ext[0] for ext in exts), min(ext[1] for ext in exts),
+            max(ext[2] for ext in exts), max(ext[3] for ext in exts))
+
+
+def overlap_extent(ext1, ext2):
+    if ext1 is None or ext2 is None:
+        return False
+    return (ext1[0] < ext2[2] and ext2[0] < ext1[2] and
+            ext1[1] < ext2[3] and ext2[1] < ext1[3])
+
+
+def view_extent(img, ext):
+    if ext is None:
+        return img
+    x0, y0, x1, y1 = ext
+    return img[y0:y1, x0:x1]
+
+
+def aligned_range(lo, hi, size, src_size):
+    """
+    [lo, hi) of an axis resized from src_size to size, widened to whole
+    steps of the ratio and 2 more steps for interpolation, and the range
+    of the source which resizes exactly into it
+    """
+    g = math.gcd(size, src_size)
+    p, q = size // g, src_size // g
+    k0 = max(lo // p - 2, 0)
+    k1 = min(-(-hi // p) + 2, g)
+    return (k0 * p, k1 * p, k0 * q, k1 * q)
+
+
+def alpha_extent(img):
+    h, w, a = img.shape
+    if a == 3:
+        return (0, 0, w, h)
+
+    mask = img[:, :, 3]
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+
 class BoundingBox:
+    # every pixel of image() is either fully opaque or fully transparent,
+    # so drawing it through a transparent canvas does not change it.
+    opaque = True
+
     def __init__(self, width, height, duration):
         self.width = width
         self.height = height
         self.duration = duration
-
-    def image(self, t):
-        temp = np.zeros([self.height, self.width, 4],
-                        dtype=np.uint8)
-
-        return np.zeros([self.height, self.width, 4],
-                        dtype=np.uint8)
+        self.buffer = None
+
+        # image() is fully transparent outside the closed time range active
+        # and outside the rectangle extent = (x0, y0, x1, y1); None if always
+        self.active = None
+        self.extent = None
+
+        # image() is the same for every t in [span[0], span[1]), so the last
+        # result is returned again without rendering.
+        self.span = (0., 0.)
+        self.memo = None
+        self.region = None
+
+    def canvas(self, region=None):
+        # reused between frames: image() returns it, so callers must not
+        # keep the result beyond the next call.
+        x0, y0, x1, y1 = region or (0, 0, self.width, self.height)
+        shape = (y1 - y0, x1 - x0, 4)
+        if self.buffer is None or self.buffer.shape != shape:
+            self.buffer = np.zeros(shape, dtype=np.uint8)
+        else:
+            self.buffer.fill(0)
+
+        return self.buffer
+
+    def image(self, t, region=None):
+        """
+        image at t, or only its part region = (x0, y0, x1, y1) if given
+        """
+        lo, hi = self.span
+        if lo <= t < hi and self.memo is not None and self.region == region:
+            return self.memo
+
+        self.memo = self.render(t, region)
+        self.region = region
+        return self.memo
+
+    def render(self, t, region):
+        self.span = (-INF, INF)
+        return self.canvas(region)
+
+    def idle(self, t):
+        """
+        span of times around t in which image() is fully transparent
+        """
+        if self.active is None or self.extent is None:
+            return (-INF, INF)
+
+        lo, hi = self.active
+        if t < lo:
+            return (-INF, lo)
+        elif hi < t:
+            return (hi + EPSILON, INF)
+        else:
+            return None
+
+    def draw(self, t, dst, *, left=0, top=0, canvases=0):
+        if idle := self.idle(t):
+            # nothing to blend, but the span is kept for the parent
+            self.span = idle
+            self.memo = None
+            return dst
+        else:
+            return self.paint(t, dst, left, top, canvases)
+
+    def paint(self, t, dst, left, top, canvases):
+        # only the part of extent which falls in dst is rendered
+        h, w, _ = dst.shape
+        visible = clip_extent(shift_extent(self.extent, left, top), w, h)
+        if visible is not None:
+            img = self.image(t, shift_extent(visible, -left, -top))
+            alpha_brend(dst, img, left=visible[0], top=visible[1],
+                        canvases=canvases)
+        return dst
+
+    def _draw_through(self, bb, t, dst, left, top, canvases):
+        # same as blending bb into transparent canvases first, including
+        # the one of self
+        return bb.draw(t, dst, left=left, top=top, canvases=canvases)
 
     def boundings(self):
         return (self.width, self.height, self.duration)
 
 
 class MovieBB(BoundingBox):
-    def __init__(self, fname):
-        if isinstance(fname, str):
+    def __init__(self, fname, *, buffer_size=8, max_gap=60, pool=None):
+        self.pool = None
+        if isinstance(fname, str) and pool:
+            self.fname = fname
+            self.pool = pool
+            self.key, self.source = pool.acquire_movie(
+                fname, buffer_size=buffer_size, max_gap=max_gap)
+            self.movie = self.source.movie
+        elif isinstance(fname, str):
             self.fname = fname
             self.movie = cv2.VideoCapture(fname)
         elif isinstance(fname, io.BytesIO):
@@ -89,36 +353,53 @@ class MovieBB(BoundingBox):
                          (self.movie.get(cv2.CAP_PROP_FRAME_COUNT) - 1) /
                          self.movie.get(cv2.CAP_PROP_FPS))
 
+        if not self.pool:
+            self.source = FrameSource(self.movie, buffer_size=buffer_size,
+                                      max_gap=max_gap)
+
+        self.active = (-INF, INF)
+        self.extent = (0, 0, self.width, self.height)
+
     def __del__(self):
-        self.movie.release()
+        if self.pool:
+            self.pool.release_movie(self.key, self.source)
+        else:
+            self.movie.release()
 
-    def image(self, t):
-        self.movie.set(0, t * 1000)
-        ret, frame = self.movie.read()
-        if ret:
-            return frame
+    def render(self, t, region):
+        frame = self.source.frame(t)
+        self.span = (t, t)
+        if frame is not None:
+            return view_extent(frame, region)
         else:
-            return super().image(t)
+            return self.canvas(region)
 
 
 class TextBB(BoundingBox):
-    def __init__(self, duration: float, text: str, fontPIL, colorBGR: tuple):
-        w, h = get_textbbox(text, fontPIL)
+    def __init__(self, duration: float, text: str, fontPIL, colorBGR: tuple,
+                 *, cache=None):
+        self.raster = (cache or TextCache()).raster(text, fontPIL, colorBGR)
+        h, w, _ = self.raster.shape
         super().__init__(w, h, duration)
 
         self.text = text
         self.fontPIL = fontPIL
         self.colorBGR = colorBGR
+        self.opaque = False
+        self.active = (-INF, INF)
+        self.extent = alpha_extent(self.raster)
 
-    def image(self, t):
-        img = super().image(t)
-        put_text(img, self.text, 0, 0, self.fontPIL, self.colorBGR)
-        return img
+    def render(self, t, region):
+        self.span = (-INF, INF)
+        return view_extent(self.raster, region)
 
 
 class ImageBB(BoundingBox):
-    def __init__(self, duration: float, fname: str):
-        if isinstance(fname, str):
+    def __init__(self, duration: float, fname: str, *, pool=None):
+        if isinstance(fname, str) and pool:
+            self.fname = fname
+            self.frame = pool.image(fname)
+        elif isinstance(fname, str):
             self.fname = fname
             self.frame = cv2.imread(fname, cv2.IMREAD_UNCHANGED)
         elif isinstance(fname, io.BytesIO):
@@ -127,11 +408,18 @@ class ImageBB(BoundingBox):
         else:
             assert False
 
-        h, w, _ = self.frame.shape
+        h, w, a = self.frame.shape
         super().__init__(w, h, duration)
 
-    def image(self, t):
-        return self.frame.copy()
+        self.frame.flags.writeable = False
+        self.opaque = a == 3 or bool(
+            np.isin(self.frame[:, :, 3], (0, 255)).all())
+        self.active = (-INF, INF)
+        self.extent = alpha_extent(self.frame)
+
+    def render(self, t, region):
+        self.span = (-INF, INF)
+        return view_extent(self.frame, region)
 
 
 class CropBB(BoundingBox):
@@ -158,13 +446,23 @@ class CropBB(BoundingBox):
         self.x1 = x1
         self.y1 = y1
         self.t1 = t1
+        self.opaque = bb.opaque
+        self.active = clip_range(shift_range(bb.active, -t0),
+                                 -INF, t1 - t0 + EPSILON)
+        self.extent = clip_extent(shift_extent(bb.extent, -x0, -y0),
+                                  self.width, self.height)
 
-    def image(self, t):
+    def render(self, t, region):
         if self.t0 + t <= self.t1:
-            img = self.bb.image(t + self.t0)
-            return img[self.y0:self.y1, self.x0:self.x1, :]
+            # the child renders only the pixels kept
+            img = self.bb.image(t + self.t0, shift_extent(
+                region or (0, 0, self.width, self.height), self.x0, self.y0))
+            self.span = clip_span(shift_span(self.bb.span, -self.t0),
+                                  -INF, self.t1 - self.t0)
+            return img
         else:
-            return super().image(t)
+            self.span = (self.t1 - self.t0 + EPSILON, INF)
+            return self.canvas(region)
 
 
 class MarginBB(BoundingBox):
@@ -191,16 +489,40 @@ class MarginBB(BoundingBox):
         self.right = right
         self.bottom = bottom
         self.after = after
+        self.opaque = bb.opaque
+        self.active = clip_range(shift_range(bb.active, before),
+                                 before - EPSILON,
+                                 before + duration + EPSILON)
+        self.extent = shift_extent(bb.extent, left, top)
 
-    def image(self, t):
+    def _span(self, t):
         width, height, duration = self.bb.boundings()
-        if self.before <= t <= self.before + duration:
-            img = super().image(t)
-            alpha_brend(img, self.bb.image(t - self.before),
-                        left=self.left, top=self.top)
-            return img
+        if t < self.before:
+            return (-INF, self.before)
+        elif self.before + duration < t:
+            return (self.before + duration + EPSILON, INF)
         else:
-            return super().image(t)
+            return clip_span(shift_span(self.bb.span, self.before),
+                             self.before, self.before + duration)
+
+    def render(self, t, region):
+        width, height, duration = self.bb.boundings()
+        x0, y0, _, _ = region or (0, 0, 0, 0)
+        img = self.canvas(region)
+        if self.before <= t <= self.before + duration:
+            self.bb.draw(t - self.before, img,
+                         left=self.left - x0, top=self.top - y0)
+        self.span = self._span(t)
+        return img
+
+    def paint(self, t, dst, left, top, canvases):
+        width, height, duration = self.bb.boundings()
+        self.memo = None
+        if self.before <= t <= self.before + duration:
+            self._draw_through(self.bb, t - self.before, dst,
+                               left + self.left, top + self.top, canvases + 1)
+        self.span = self._span(t)
+        return dst
 
 
 class ScaleBB(BoundingBox):
@@ -215,14 +537,55 @@ class ScaleBB(BoundingBox):
         self.bb = bb
         self.fxy = fxy
         self.ft = ft
-
-    def image(self, t):
+        self.resized = None
+        # resizing to the same size copies the image as it is
+        self.resizes = (self.width, self.height) != (width, height)
+        # resizing blurs the edges between opaque and transparent pixels
+        self.opaque = bb.opaque and not self.resizes
+        self.active = clip_range(shift_range(bb.active, scale=ft),
+                                 -INF, self.duration + EPSILON)
+        if bb.extent is None:
+            self.extent = None
+        else:
+            # interpolation spreads into neighbouring pixels
+            x0, y0, x1, y1 = bb.extent
+            fx, fy = self.width / width, self.height / height
+            self.extent = clip_extent((
+                int(np.floor((x0 - 1) * fx)) - 1,
+                int(np.floor((y0 - 1) * fy)) - 1,
+                int(np.ceil((x1 + 1) * fx)) + 1,
+                int(np.ceil((y1 + 1) * fy)) + 1), self.width, self.height)
+
+    def render(self, t, region):
         width, height, duration = self.bb.boundings()
         if self.duration < t:
-            return super().image(t)
+            self.span = (self.duration + EPSILON, INF)
+            return self.canvas(region)
+        elif not self.resizes:
+            img = self.bb.image(t / self.ft, region)
         else:
-            img = self.bb.image(t / self.ft)
-            return cv2.resize(img, dsize=(self.width, self.height))
+            # resizing a part aligned to the ratio gives the same pixels as
+            # resizing the whole
+            x0, y0, x1, y1 = region or (0, 0, self.width, self.height)
+            (X0, X1, sx0, sx1) = aligned_range(x0, x1, self.width, width)
+            (Y0, Y1, sy0, sy1) = aligned_range(y0, y1, self.height, height)
+            img = self.bb.image(t / self.ft, (sx0, sy0, sx1, sy1))
+            self.resized = cv2.resize(img, dsize=(X1 - X0, Y1 - Y0),
+                                      dst=self.resized)
+            img = self.resized[y0 - Y0:y1 - Y0, x0 - X0:x1 - X0]
+        self.span = clip_span(shift_span(self.bb.span, scale=self.ft),
+                              -INF, self.duration)
+        return img
+
+    def paint(self, t, dst, left, top, canvases):
+        if self.resizes or self.duration < t:
+            return super().paint(t, dst, left, top, canvases)
+
+        self.memo = None
+        self.bb.draw(t / self.ft, dst, left=left, top=top, canvases=canvases)
+        self.span = clip_span(shift_span(self.bb.span, scale=self.ft),
+                              -INF, self.duration)
+        return dst
 
 
 class ParBB(BoundingBox):
@@ -233,34 +596,92 @@ class ParBB(BoundingBox):
                          max(b[1] for b in temp), max(b[2] for b in temp))
 
         self.bblst = bblst
+        self.opaque = all(bb.opaque for bb in bblst)
+        # children which never overlap blend into dst as into the canvas
+        self.disjoint = not any(
+            overlap_extent(bb1.extent, bb2.extent)
+            for (bb1, bb2) in itertools.combinations(bblst, 2)
+            if bb1.active is not None and bb2.active is not None)
+        self.active = clip_range(hull_range(bb.active for bb in bblst),
+                                 -INF, self.duration + EPSILON)
+        self.extent = hull_extent(bb.extent for bb in bblst)
+
+    def _span(self, t):
+        if self.duration < t:
+            return (self.duration + EPSILON, INF)
 
-    def image(self, t):
-        width, height, duration = self.boundings()
+        span = (-INF, self.duration)
+        for bb in self.bblst:
+            span = clip_span(span, *bb.span)
+        return span
 
-        if self.duration < t:
-            return super().image(t)
-        else:
-            img = super().image(t)
+    def render(self, t, region):
+        x0, y0, _, _ = region or (0, 0, 0, 0)
+        img = self.canvas(region)
+        if t <= self.duration:
             for bb in self.bblst:
-                alpha_brend(img, bb.image(t))
-            return img
+                bb.draw(t, img, left=-x0, top=-y0)
+        self.span = self._span(t)
+        return img
+
+    def paint(self, t, dst, left, top, canvases):
+        if not self.opaque and not self.disjoint:
+            return super().paint(t, dst, left, top, canvases)
+
+        self.memo = None
+        if t <= self.duration:
+            for bb in self.bblst:
+                self._draw_through(bb, t, dst, left, top, canvases + 1)
+        self.span = self._span(t)
+        return dst
 
 
 class SeqBB(BoundingBox):
     def __init__(self, bblst):
         temp = [bb.boundings() for bb in bblst]
 
+        # starts[i] is the start time of bblst[i], starts[-1] is the end
+        self.starts = list(itertools.accumulate(
+            (b[2] for b in temp), initial=0.))
+
         super().__init__(max(b[0] for b in temp),
-                         max(b[1] for b in temp), sum(b[2] for b in temp))
+                         max(b[1] for b in temp), self.starts[-1])
 
         self.bblst = bblst
-
-    def image(self, t):
-        for bb in self.bblst:
-            _, _, duration = bb.boundings()
-
-            if t < duration:
-                return alpha_brend(super().image(t), bb.image(t))
-            else:
-                t -= duration
-        return super().image(t)
+        self.opaque = all(bb.opaque for bb in bblst)
+        self.last = 0
+        self.active = hull_range(
+            clip_range(shift_range(bb.active, start),
+                       -INF if i == 0 else start - EPSILON, end + EPSILON)
+            for (i, (bb, start, end)) in enumerate(
+                zip(bblst, self.starts, self.starts[1:])))
+        self.extent = hull_extent(bb.extent for bb in bblst)
+
+    def _index(self, t):
+        # consecutive frames mostly fall in the same child as the last one
+        i = self.last
+        if not self.starts[i] <= t < self.starts[i + 1]:
+            i = max(bisect.bisect_right(self.starts, t) - 1, 0)
+            self.last = min(i, len(self.bblst) - 1)
+        return i
+
+    def _draw_active(self, t, dst, left, top, canvases):
+        i = self._index(t)
+        if len(self.bblst) <= i:
+            self.span = (self.starts[-1] + EPSILON, INF)
+            return dst
+
+        bb = self.bblst[i]
+        start = self.starts[i]
+        self._draw_through(bb, t - start, dst, left, top, canvases)
+        self.span = clip_span(shift_span(bb.span, start),
+                              start, self.starts[i + 1])
+        return dst
+
+    def render(self, t, region):
+        x0, y0, _, _ = region or (0, 0, 0, 0)
+        return self._draw_active(t, self.canvas(region), -x0, -y0, 0)
+
+    def paint(self, t, dst, left, top, canvases):
+        self.memo = None
+        return self._draw_active(t, dst, left, top, canvases + 1)
@@ -0,0 +1,80 @@
+import collections
+import cv2
+
+
+class FrameSource:
+    def __init__(self, movie, *, buffer_size=8, max_gap=60, peers=()):
+        """
+        frames of movie decoded by its own cursor; frames buffered by peers,
+        readers of the same file, are taken without decoding
+        """
+        assert 0 < buffer_size, "0 < buffer_size is needed."
+        assert 0 <= max_gap, "0 <= max_gap is needed."
+
+        self.movie = movie
+        self.fps = movie.get(cv2.CAP_PROP_FPS)
+        self.buffer_size = buffer_size
+        self.max_gap = max_gap
+        self.peers = peers
+
+        self.buffer = collections.OrderedDict()
+        self.position = 0
+        self.end = None
+
+        self.decodes = 0
+        self.seeks = 0
+        self.hits = 0
+
+    def index(self, t):
+        return int(t * self.fps + 0.5)
+
+    def frame(self, t):
+        index = self.index(t)
+
+        if index in self.buffer:
+            self.hits += 1
+            return self.buffer[index]
+        if self.end is not None and self.end <= index:
+            return None
+        for peer in self.peers:
+            if peer is not self and index in peer.buffer:
+                self.hits += 1
+                return peer.buffer[index]
+
+        if self.position is None or index < self.position or \
+                self.max_gap < index - self.position:
+            self.movie.set(cv2.CAP_PROP_POS_FRAMES, index)
+            self.position = index
+            self.seeks += 1
+
+        # frames which would be evicted before the target are only grabbed
+        while self.position < index - self.buffer_size + 1:
+            if not self.movie.grab():
+                self.end = self.position
+                self.position = None
+                return None
+            self.decodes += 1
+            self.position += 1
+
+        frame = None
+        while self.position <= index:
+            ret, frame = self.movie.read()
+            if not ret:
+                self.end = self.position
+                self.position = None
+                return None
+            self.decodes += 1
+            frame.flags.writeable = False
+            self.buffer[self.position] = frame
+            if self.buffer_size < len(self.buffer):
+                self.buffer.popitem(last=False)
+            self.position += 1
+
+        return frame
+
+    def stats(self):
+        return {
+            "decodes": self.decodes,
+            "seeks": self.seeks,
+            "hits": self.hits,
+        }
@@ -0,0 +1,27 @@
+from .boundingbox import CropBB, ParBB, SeqBB
+
+
+def merge_crops(bb, merged=None):
+    """
+    bb with every crop of a crop starting at 0s merged into one CropBB, so
+    that the child is sliced once; merged maps each outer crop replaced to
+    the CropBB replacing it
+    """
+    if isinstance(bb, (ParBB, SeqBB)):
+        bb.bblst = [merge_crops(child, merged) for child in bb.bblst]
+        return bb
+    if not hasattr(bb, "bb"):
+        return bb
+
+    bb.bb = merge_crops(bb.bb, merged)
+
+    inner = bb.bb
+    if isinstance(bb, CropBB) and isinstance(inner, CropBB) and \
+            bb.t0 == 0 and inner.t0 == 0:
+        crop = CropBB(inner.bb, inner.x0 + bb.x0, inner.y0 + bb.y0, 0,
+                      inner.x0 + bb.x1, inner.y0 + bb.y1, bb.t1)
+        if merged is not None:
+            merged[bb] = crop
+        return crop
+
+    return bb
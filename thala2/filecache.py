@@ -0,0 +1,98 @@
+import os
+import tempfile
+import threading
+
+
+class FileCache:
+    """
+    files in directory, the least recently used of which are removed when
+    they take more than max_bytes together
+    """
+
+    def __init__(self, directory, max_bytes):
+        super().__init__()
+
+        assert 0 < max_bytes, "0 < max_bytes is needed."
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        # running total of the entries, so that storing does not rescan
+        self.__size = sum(size for (_, size, _) in self._entries())
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def touch(self, path):
+        os.utime(path)
+
+    def temp(self):
+        """
+        path of a new temporary file, which prune() leaves alone
+        """
+        (fd, temp) = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return temp
+
+    def store(self, name, write):
+        """
+        write(f) into a temporary file, renamed to name once it is complete
+        """
+        temp = self.temp()
+        try:
+            with open(temp, "wb") as f:
+                write(f)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        return self.add(name, temp)
+
+    def add(self, name, temp):
+        """
+        move the complete file temp into the cache as name
+        """
+        path = self.path(name)
+        with self.__lock:
+            try:
+                self.__size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(temp, path)
+            self.__size += os.path.getsize(path)
+
+        return path
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def prune(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes;
+        the directory is only scanned when the running total exceeds it
+        """
+        with self.__lock:
+            if self.__size <= self.max_bytes:
+                return
+
+            entries = self._entries()
+            total = sum(size for (_, size, _) in entries)
+            for (_, size, path) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # still mapped on some platforms
+                    continue
+                total -= size
+            self.__size = total
@@ -0,0 +1,74 @@
+import os
+import cv2
+import pydub
+from .bbox import FrameSource
+from .track.track import conform
+
+
+class MediaPool:
+    def __init__(self):
+        super().__init__()
+
+        self.__movies = {}
+        self.__images = {}
+        self.__audios = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def key(self, src):
+        path = os.path.abspath(src)
+        return (path, os.path.getmtime(path))
+
+    def acquire_movie(self, src, **kwargs):
+        """
+        (key, reader) of src; every reader has its own cursor, so uses at
+        different offsets do not seek each other, and shares the frames
+        buffered by the other readers of the same file
+        """
+        key = self.key(src)
+        peers = self.__movies.setdefault(key, [])
+        source = FrameSource(cv2.VideoCapture(src), peers=peers, **kwargs)
+        peers.append(source)
+
+        return (key, source)
+
+    def release_movie(self, key, source):
+        peers = self.__movies.get(key, [])
+        if source in peers:
+            peers.remove(source)
+            source.movie.release()
+            if not peers:
+                del self.__movies[key]
+
+    def image(self, src):
+        key = self.key(src)
+        if key not in self.__images:
+            self.__images[key] = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+
+        return self.__images[key]
+
+    def audio(self, src, format=None):
+        """
+        audio of src, converted into format = (frame_rate, channels,
+        sample_width) once if it is given
+        """
+        key = (self.key(src), format)
+        if key not in self.__audios:
+            audio = pydub.AudioSegment.from_file(src)
+            if format:
+                audio = conform(audio, *format)
+            self.__audios[key] = audio
+
+        return self.__audios[key]
+
+    def close(self):
+        for peers in self.__movies.values():
+            for source in peers:
+                source.movie.release()
+        self.__movies.clear()
+        self.__images.clear()
+        self.__audios.clear()
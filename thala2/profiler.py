@@ -0,0 +1,224 @@
+import json
+import time
+import weakref
+import xml.etree.ElementTree as ET
+from xml.parsers import expat
+
+
+def parse(source):
+    """
+    (root, lines) of the XML file source, where lines maps each element to
+    the line it starts at
+    """
+    builder = ET.TreeBuilder()
+    parser = expat.ParserCreate()
+    lines = {}
+
+    def start(tag, attrib):
+        lines[builder.start(tag, attrib)] = parser.CurrentLineNumber
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = builder.end
+    parser.CharacterDataHandler = builder.data
+    with open(source, "rb") as f:
+        parser.ParseFile(f)
+
+    return (builder.close(), lines)
+
+
+class Profiler:
+    def __init__(self, *, lines=None, max_events=1000000):
+        """
+        statistics of each element while it is built and rendered, keyed by
+        its XML path; lines from parse() maps them back to the document
+        """
+        super().__init__()
+
+        self.lines = lines or {}
+        self.max_events = max_events
+
+        self.paths = {}
+        self.nodes = {}
+        self.caches = {}
+        self.sources = {}
+        self.events = []
+        self.stack = []
+        self.watched = weakref.WeakSet()
+        self.origin = time.perf_counter()
+
+    def document(self, root):
+        """
+        XPath-like paths of every element under root
+        """
+        def walk(elem, path):
+            self.paths[elem] = path
+            counts = {}
+            for child in elem:
+                counts[child.tag] = counts.get(child.tag, 0) + 1
+                walk(child, f"{path}/{child.tag}[{counts[child.tag]}]")
+
+        walk(root, f"/{root.tag}")
+
+    def node(self, elem, kind):
+        path = self.paths.get(elem, f"?/{elem.tag}")
+        key = (path, kind)
+        if key not in self.nodes:
+            self.nodes[key] = {
+                "path": path,
+                "kind": kind,
+                "tag": elem.tag,
+                "line": self.lines.get(elem),
+                "calls": 0,
+                "images": 0,
+                "renders": 0,
+                "time": 0.,
+                "self": 0.,
+                "bytes": 0,
+                "depth": 0,
+            }
+        return self.nodes[key]
+
+    def observe(self, name, cache):
+        """
+        report hits and misses of cache as name
+        """
+        if cache is not None and hasattr(cache, "hits"):
+            self.caches[name] = cache
+
+    def _enter(self, node):
+        node["depth"] += 1
+        self.stack.append([time.perf_counter(), 0.])
+
+    def _leave(self, node):
+        (start, children) = self.stack.pop()
+        duration = time.perf_counter() - start
+        node["self"] += duration - children
+        node["depth"] -= 1
+        if self.stack:
+            self.stack[-1][1] += duration
+
+        # a node calling itself, like draw() through image(), is one call
+        if node["depth"] == 0:
+            node["calls"] += 1
+            node["time"] += duration
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    "name": node["tag"],
+                    "cat": node["kind"],
+                    "ph": "X",
+                    "ts": (start - self.origin) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": 0,
+                    "tid": 0,
+                    "args": {"path": node["path"], "line": node["line"]},
+                })
+
+    def _timed(self, node, method):
+        def timed(*args, **kwargs):
+            self._enter(node)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self._leave(node)
+        return timed
+
+    def watch(self, elem, bb):
+        """
+        record draw(), image() and render() of the bounding box of elem,
+        unless it is recorded as that of another element
+        """
+        if bb in self.watched:
+            return
+        self.watched.add(bb)
+
+        node = self.node(elem, "video")
+        (image, render) = (bb.image, bb.render)
+
+        # image() without render() is a hit of the memo
+        def counted_image(*args, **kwargs):
+            node["images"] += 1
+            return image(*args, **kwargs)
+
+        def counted_render(t, region):
+            img = render(t, region)
+            node["renders"] += 1
+            node["bytes"] += img.nbytes
+            return img
+
+        bb.render = counted_render
+        bb.image = self._timed(node, counted_image)
+        bb.draw = self._timed(node, bb.draw)
+        if hasattr(bb, "source"):
+            self.sources[node["path"]] = bb.source
+
+    def call(self, elem, build, *args):
+        """
+        build(*args) recorded as the audio of elem
+        """
+        node = self.node(elem, "audio")
+        self._enter(node)
+        try:
+            track = build(*args)
+        finally:
+            self._leave(node)
+        node["bytes"] += track.frames * track.channels * 4
+        return track
+
+    def stats(self):
+        nodes = []
+        for node in self.nodes.values():
+            node = {key: value for (key, value) in node.items()
+                    if key != "depth"}
+            if node["path"] in self.sources and node["kind"] == "video":
+                node["frames"] = self.sources[node["path"]].stats()
+            nodes.append(node)
+        nodes.sort(key=lambda node: node["self"], reverse=True)
+
+        return {
+            "nodes": nodes,
+            "caches": {name: {"hits": cache.hits, "misses": cache.misses}
+                       for (name, cache) in self.caches.items()},
+        }
+
+    def report(self, *, limit=None):
+        """
+        text table of the elements sorted by the time spent in themselves
+        """
+        stats = self.stats()
+        rows = [f"{'self[ms]':>10} {'total[ms]':>10} {'calls':>7} "
+                f"{'hits':>6} {'MB':>8} {'line':>5}  kind  path"]
+        for node in stats["nodes"][:limit]:
+            if node["images"]:
+                hits = f"{1 - node['renders'] / node['images']:6.0%}"
+            else:
+                hits = f"{'-':>6}"
+            line = node["line"] if node["line"] is not None else "-"
+            row = (f"{node['self'] * 1e3:10.1f} {node['time'] * 1e3:10.1f} "
+                   f"{node['calls']:7d} {hits} "
+                   f"{node['bytes'] / 2 ** 20:8.1f} {line:>5}  "
+                   f"{node['kind']:5} {node['path']}")
+            if "frames" in node:
+                frames = node["frames"]
+                row += (f" (decodes {frames['decodes']}, seeks "
+                        f"{frames['seeks']}, hits {frames['hits']})")
+            rows.append(row)
+
+        for (name, cache) in stats["caches"].items():
+            total = cache["hits"] + cache["misses"]
+            rate = f"{cache['hits'] / total:.0%}" if total else "-"
+            rows.append(f"{name} cache: {cache['hits']} hits, "
+                        f"{cache['misses']} misses ({rate})")
+
+        return "\n".join(rows)
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.stats(), f, ensure_ascii=False, indent=1)
+
+    def save_trace(self, path):
+        """
+        Chrome trace of every outermost call, for chrome://tracing or
+        Perfetto
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events}, f, ensure_ascii=False)
@@ -0,0 +1,115 @@
+import os
+import json
+import hashlib
+import subprocess
+import cv2
+from moviepy.config import get_setting
+from .filecache import FileCache
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "thala2",
+                                 "proxy")
+
+
+def proxy_size(width, height, scale):
+    return (max(round(width * scale), 1), max(round(height * scale), 1))
+
+
+class ProxyCache:
+    def __init__(self, *, directory=DEFAULT_DIRECTORY,
+                 max_bytes=4 * 1024 * 1024 * 1024, ffmpeg=None):
+        super().__init__()
+
+        self.__files = FileCache(directory, max_bytes)
+        self.__ffmpeg = ffmpeg
+
+        self.hits = 0
+        self.misses = 0
+
+    def options(self):
+        """
+        keyword arguments of the same cache, for worker processes
+        """
+        return {
+            "directory": self.__files.directory,
+            "max_bytes": self.__files.max_bytes,
+            "ffmpeg": self.__ffmpeg,
+        }
+
+    def key(self, src, scale):
+        path = os.path.abspath(src)
+        stat = os.stat(path)
+        ident = [path, stat.st_mtime, stat.st_size, scale]
+        return hashlib.sha256(json.dumps(ident).encode()).hexdigest()
+
+    def _lookup(self, src, scale, ext):
+        name = self.key(src, scale) + ext
+        path = self.__files.path(name)
+        if os.path.exists(path):
+            self.__files.touch(path)
+            self.hits += 1
+            return (name, path)
+
+        self.misses += 1
+        return (name, None)
+
+    def movie(self, src, scale):
+        """
+        path of src transcoded into scale times the size once; the frames
+        and their rate are kept, so the timing does not change
+        """
+        (name, path) = self._lookup(src, scale, ".mp4")
+        if path:
+            return path
+
+        movie = cv2.VideoCapture(src)
+        (width, height) = proxy_size(
+            int(movie.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            int(movie.get(cv2.CAP_PROP_FRAME_HEIGHT)), scale)
+        movie.release()
+
+        temp = self.__files.temp()
+        command = [self.__ffmpeg or get_setting("FFMPEG_BINARY"), "-y",
+                   "-loglevel", "error", "-i", src, "-an",
+                   "-vf", f"scale={width}:{height}:flags=area",
+                   "-vsync", "passthrough",
+                   "-c:v", "libx264", "-preset", "ultrafast",
+                   "-pix_fmt", "yuv420p" if width % 2 == 0 and
+                   height % 2 == 0 else "yuv444p", "-f", "mp4", temp]
+        process = subprocess.run(command, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            os.remove(temp)
+        assert process.returncode == 0, \
+            f"ffmpeg failed: {process.stderr.decode(errors='replace')}"
+
+        path = self.__files.add(name, temp)
+        self.prune()
+
+        return path
+
+    def image(self, src, scale):
+        """
+        path of src resized into scale times the size once
+        """
+        (name, path) = self._lookup(src, scale, ".png")
+        if path:
+            return path
+
+        img = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+        (height, width) = img.shape[:2]
+        img = cv2.resize(img, proxy_size(width, height, scale),
+                         interpolation=cv2.INTER_AREA)
+        (ret, data) = cv2.imencode(".png", img)
+        assert ret, f"{src} could not be resized."
+
+        path = self.__files.store(name, lambda f: f.write(data.tobytes()))
+        self.prune()
+
+        return path
+
+    def prune(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes
+        """
+        self.__files.prune()
@@ -0,0 +1,2 @@
+from .track import Track, SampleTrack, SegmentTrack, CropTrack, MarginTrack, ScaleTrack, StretchTrack, ParTrack, SeqTrack
+from .cache import MappedTrack, TrackCache
@@ -0,0 +1,72 @@
+import os
+import numpy as np
+from .track import SampleTrack
+from ..filecache import FileCache
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "thala2",
+                                 "track")
+
+
+class MappedTrack(SampleTrack):
+    def __init__(self, path, frame_rate, channels, sample_width):
+        # kept in float32 as mixed, so a cached node sounds the same
+        super().__init__(np.memmap(path, dtype=np.float32,
+                                   mode="r").reshape(-1, channels),
+                         frame_rate, sample_width)
+        self.path = path
+
+
+class TrackCache:
+    def __init__(self, *, directory=DEFAULT_DIRECTORY,
+                 max_bytes=4 * 1024 * 1024 * 1024):
+        super().__init__()
+
+        self.__files = FileCache(directory, max_bytes)
+
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return self.__files.path(key + ".pcm")
+
+    def load(self, key, format):
+        """
+        track of key in format = (frame_rate, channels, sample_width), or
+        None if it is not cached
+        """
+        path = self.path(key)
+        try:
+            if 0 < os.path.getsize(path):
+                track = MappedTrack(path, *format)
+                self.__files.touch(path)
+                self.hits += 1
+                return track
+        except FileNotFoundError:
+            pass
+
+        self.misses += 1
+        return None
+
+    def store(self, key, track):
+        """
+        write the samples of track, and return them mapped from the file
+        """
+        if track.frames == 0:
+            return track
+
+        def write(f):
+            for block in track.blocks():
+                f.write(block.tobytes())
+
+        path = self.__files.store(key + ".pcm", write)
+        mapped = MappedTrack(path, *track.format())
+        self.prune()
+
+        return mapped
+
+    def prune(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes
+        """
+        self.__files.prune()
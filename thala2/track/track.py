@@ -0,0 +1,299 @@
+import bisect
+import itertools
+import math
+import numpy as np
+import pydub
+
+
+# frames pulled at once when a whole track is evaluated
+BLOCK_SIZE = 65536
+
+DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+def conform(segment, frame_rate, channels, sample_width):
+    """
+    segment converted into the format of the render at once
+    """
+    if segment.channels != channels:
+        segment = segment.set_channels(channels)
+    if segment.frame_rate != frame_rate:
+        # audioop.ratecv may drop the last frame, which would shorten
+        # the duration seen by the video
+        frames = round(segment.frame_count() * frame_rate /
+                       segment.frame_rate)
+        segment = segment.set_frame_rate(frame_rate)
+        data = segment.raw_data[:frames * segment.frame_width]
+        segment = pydub.AudioSegment(
+            data=data + bytes(frames * segment.frame_width - len(data)),
+            sample_width=segment.sample_width, frame_rate=frame_rate,
+            channels=segment.channels)
+    if segment.sample_width != sample_width:
+        segment = segment.set_sample_width(sample_width)
+    return segment
+
+
+class Track:
+    def __init__(self, frame_rate, channels, sample_width, frames):
+        assert sample_width in DTYPES, f"sample_width in {tuple(DTYPES)} is needed."
+
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.frames = frames
+
+    def format(self):
+        return (self.frame_rate, self.channels, self.sample_width)
+
+    @property
+    def duration_seconds(self):
+        return self.frames / self.frame_rate
+
+    def read(self, start, count):
+        """
+        samples [start, start + count) as float32, silent out of the track
+        """
+        out = np.zeros([count, self.channels], dtype=np.float32)
+        lo = max(start, 0)
+        hi = min(start + count, self.frames)
+        if lo < hi:
+            self.mix(lo, hi - lo, out[lo - start:hi - start])
+        return out
+
+    def mix(self, start, count, out):
+        """
+        add samples [start, start + count) within the track into out
+        """
+        pass
+
+    def blocks(self, block_size=BLOCK_SIZE):
+        for start in range(0, self.frames, block_size):
+            yield self.read(start, min(block_size, self.frames - start))
+
+    def raw_blocks(self, block_size=BLOCK_SIZE):
+        dtype = DTYPES[self.sample_width]
+        scale = float(2 ** (8 * self.sample_width - 1))
+        # scale - 1 rounds up to scale in float32 for 4 bytes, so the
+        # largest float32 below it is the upper bound, truncated by astype
+        high = np.nextafter(np.float32(scale), np.float32(0))
+        for block in self.blocks(block_size):
+            # saturated once, after every track is mixed
+            block *= scale
+            np.rint(block, out=block)
+            np.minimum(block, high, out=block)
+            np.maximum(block, -scale, out=block)
+            yield block.astype(dtype).tobytes()
+
+    @property
+    def raw_data(self):
+        return b"".join(self.raw_blocks())
+
+    def segment(self):
+        return pydub.AudioSegment(data=self.raw_data,
+                                  sample_width=self.sample_width,
+                                  frame_rate=self.frame_rate,
+                                  channels=self.channels)
+
+
+class SampleTrack(Track):
+    def __init__(self, samples, frame_rate, sample_width):
+        """
+        samples is an array of (frames, channels), integers of sample_width
+        or float32 already mixed
+        """
+        super().__init__(frame_rate, samples.shape[1], sample_width,
+                         samples.shape[0])
+
+        self.samples = samples
+        if samples.dtype == np.float32:
+            self.factor = np.float32(1)
+        else:
+            self.factor = np.float32(2 ** (1 - 8 * sample_width))
+        self.buffer = np.empty(0, dtype=np.float32)
+
+    def mix(self, start, count, out):
+        samples = self.samples[start:start + count]
+        if self.factor == 1:
+            out += samples
+            return
+        if self.buffer.shape != samples.shape:
+            self.buffer = np.empty(samples.shape, dtype=np.float32)
+        np.multiply(samples, self.factor, out=self.buffer)
+        out += self.buffer
+
+
+class SegmentTrack(SampleTrack):
+    def __init__(self, segment):
+        super().__init__(np.frombuffer(
+            segment.raw_data,
+            dtype=DTYPES[segment.sample_width]).reshape(-1, segment.channels),
+            segment.frame_rate, segment.sample_width)
+
+
+class CropTrack(Track):
+    def __init__(self, track, start, stop):
+        assert 0 <= start, "0 <= start is needed."
+
+        super().__init__(track.frame_rate, track.channels, track.sample_width,
+                         max(min(stop, track.frames) - start, 0))
+        self.track = track
+        self.start = start
+
+    def mix(self, start, count, out):
+        self.track.mix(self.start + start, count, out)
+
+
+class MarginTrack(Track):
+    def __init__(self, track, before, after):
+        assert 0 <= before, "0 <= before is needed."
+        assert 0 <= after, "0 <= after is needed."
+
+        super().__init__(track.frame_rate, track.channels, track.sample_width,
+                         before + track.frames + after)
+        self.track = track
+        self.before = before
+
+    def mix(self, start, count, out):
+        lo = max(start, self.before)
+        hi = min(start + count, self.before + self.track.frames)
+        if lo < hi:
+            self.track.mix(lo - self.before, hi - lo,
+                           out[lo - start:hi - start])
+
+
+class ScaleTrack(Track):
+    def __init__(self, track, *, gain=0.):
+        super().__init__(track.frame_rate, track.channels, track.sample_width,
+                         track.frames)
+        self.track = track
+        self.factor = np.float32(10 ** (gain / 20))
+
+    def mix(self, start, count, out):
+        if self.factor == 1:
+            self.track.mix(start, count, out)
+        else:
+            out += self.track.read(start, count) * self.factor
+
+
+class StretchTrack(Track):
+    """
+    track played ft times as long without changing the pitch by WSOLA
+    """
+
+    def __init__(self, track, ft, *, tolerance=None):
+        assert 0 < ft, "0 < ft is needed."
+
+        super().__init__(track.frame_rate, track.channels, track.sample_width,
+                         round(track.frames * ft))
+        self.track = track
+
+        # Hann windows of about 40ms overlapping by half
+        self.size = 2 ** round(math.log2(track.frame_rate * 0.04))
+        self.hop = self.size // 2
+        self.stride = self.hop / ft
+        self.tolerance = tolerance or self.size // 4
+        self.decimation = max(track.frame_rate // 11025, 1)
+        self.window = np.hanning(self.size + 1)[:-1].astype(np.float32)
+
+        # positions[k] is where the k-th window is taken from the track;
+        # they are chosen in order, so any block gives the same samples.
+        self.positions = [0]
+
+    def _nominal(self, k):
+        return round(k * self.stride)
+
+    def _search(self, region, template):
+        # coarse search on decimated samples, then refined around the best
+        d = self.decimation
+        corr = np.correlate(region[::d], template[::d], mode="valid")
+        lo = max(int(np.argmax(corr)) * d - d, 0)
+        hi = min(lo + 2 * d, len(region) - len(template))
+        corr = np.correlate(region[lo:hi + len(template)], template,
+                            mode="valid")
+        return lo + int(np.argmax(corr))
+
+    def _extend(self, k):
+        while len(self.positions) <= k:
+            k0 = len(self.positions)
+            k1 = min(k, k0 + 63)
+
+            lo = min(self.positions[-1], self._nominal(k0)) - self.tolerance
+            hi = self._nominal(k1) + self.tolerance + self.hop + self.size
+            mono = self.track.read(lo, hi - lo).mean(axis=1)
+
+            for i in range(k0, k1 + 1):
+                # the window should continue the previous one naturally
+                t0 = self.positions[-1] + self.hop - lo
+                template = mono[t0:t0 + self.size]
+                nominal = self._nominal(i)
+                r0 = max(nominal - self.tolerance, 0)
+                r1 = nominal + self.tolerance
+                region = mono[r0 - lo:r1 - lo + self.size]
+                if np.any(template) and np.any(region):
+                    self.positions.append(r0 + self._search(region, template))
+                else:
+                    self.positions.append(nominal)
+
+    def mix(self, start, count, out):
+        k0 = max(start // self.hop - 1, 0)
+        k1 = (start + count - 1) // self.hop
+        self._extend(k1)
+
+        positions = np.array(self.positions[k0:k1 + 1])
+        lo = positions.min()
+        samples = self.track.read(lo, positions.max() - lo + self.size)
+        frames = samples[(positions - lo)[:, None] + np.arange(self.size)]
+        frames *= self.window[None, :, None]
+        if k0 == 0:
+            # nothing overlaps the first half of the first window
+            frames[0, :self.hop] = samples[positions[0] - lo:][:self.hop]
+
+        acc = np.zeros([len(frames) + 1, self.hop, self.channels],
+                       dtype=np.float32)
+        acc[:-1] += frames[:, :self.hop]
+        acc[1:] += frames[:, self.hop:]
+        acc = acc.reshape(-1, self.channels)
+
+        offset = start - k0 * self.hop
+        out += acc[offset:offset + count]
+
+
+def check_format(tracks):
+    assert tracks, "at least 1 track is needed."
+    assert all(track.format() == tracks[0].format() for track in tracks), \
+        "tracks of the same format are needed."
+
+    return tracks[0].format()
+
+
+class ParTrack(Track):
+    def __init__(self, tracks):
+        super().__init__(*check_format(tracks),
+                         max(track.frames for track in tracks))
+        self.tracks = tracks
+
+    def mix(self, start, count, out):
+        # every child is added into the same block
+        for track in self.tracks:
+            hi = min(start + count, track.frames)
+            if start < hi:
+                track.mix(start, hi - start, out[:hi - start])
+
+
+class SeqTrack(Track):
+    def __init__(self, tracks):
+        # starts[i] is the first frame of tracks[i], starts[-1] is the end
+        self.starts = list(itertools.accumulate(
+            (track.frames for track in tracks), initial=0))
+        super().__init__(*check_format(tracks), self.starts[-1])
+        self.tracks = tracks
+
+    def mix(self, start, count, out):
+        i = bisect.bisect_right(self.starts, start) - 1
+        while i < len(self.tracks) and self.starts[i] < start + count:
+            lo = max(start, self.starts[i])
+            hi = min(start + count, self.starts[i + 1])
+            if lo < hi:
+                self.tracks[i].mix(lo - self.starts[i], hi - lo,
+                                   out[lo - start:hi - start])
+            i += 1
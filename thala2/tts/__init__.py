@@ -1,3 +1,5 @@
 from .tts import TTS
 from .voice_vox import VoiceVoxTTS
 from .google import GoogleTTS
+from .cache import CachedTTS
+from .prefetched import PrefetchedTTS
@@ -0,0 +1,96 @@
+import glob
+import hashlib
+import json
+import os
+import threading
+from .tts import TTS
+from ..filecache import FileCache
+
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "thala2",
+                                 "tts")
+
+
+class CachedTTS(TTS):
+    def __init__(self, tts, *, directory=DEFAULT_DIRECTORY,
+                 max_bytes=512 * 1024 * 1024):
+        super().__init__()
+
+        assert isinstance(tts, TTS), "tts should be TTS."
+
+        self.__tts = tts
+        self.__files = FileCache(directory, max_bytes)
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def batched(self):
+        return self.__tts.batched
+
+    def identity(self):
+        return self.__tts.identity()
+
+    def key(self, text: str):
+        ident = list(self.__tts.identity()) + [TTS.normalize(text)]
+        return hashlib.sha256(
+            json.dumps(ident, ensure_ascii=False).encode()).hexdigest()
+
+    def _load(self, key):
+        for path in glob.glob(self.__files.path(key + ".*")):
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                self.__files.touch(path)
+            except FileNotFoundError:
+                continue
+            with self.__lock:
+                self.hits += 1
+            return (data, os.path.splitext(path)[1][1:])
+
+        with self.__lock:
+            self.misses += 1
+        return None
+
+    def text_to_speech(self, text: str):
+        """
+        call Text-To-Speech of the wrapped engine unless it is cached
+        """
+        key = self.key(text)
+
+        if speech := self._load(key):
+            return speech
+
+        (data, fmt) = self.__tts.text_to_speech(text)
+        self._store(key, data, fmt)
+        self.prune()
+
+        return (data, fmt)
+
+    def texts_to_speech(self, texts):
+        """
+        call Text-To-Speech of the wrapped engine for uncached texts at once
+        """
+        keys = [self.key(text) for text in texts]
+        speeches = [self._load(key) for key in keys]
+
+        missing = [i for (i, speech) in enumerate(speeches) if not speech]
+        if missing:
+            synthesized = self.__tts.texts_to_speech(
+                [texts[i] for i in missing])
+            for (i, (data, fmt)) in zip(missing, synthesized):
+                self._store(keys[i], data, fmt)
+                speeches[i] = (data, fmt)
+            self.prune()
+
+        return speeches
+
+    def _store(self, key, data, fmt):
+        self.__files.store(f"{key}.{fmt}", lambda f: f.write(data))
+
+    def prune(self):
+        """
+        remove least recently used entries until the cache fits in max_bytes
+        """
+        self.__files.prune()
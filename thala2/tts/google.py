@@ -10,6 +10,9 @@ class GoogleTTS(TTS):
         self.__host = host
         self.__speaker = speaker
 
+    def identity(self):
+        return (type(self).__name__, "ja")
+
     def text_to_speech(self, text: str):
         """
         call Text-To-Speech of VOICEVOX
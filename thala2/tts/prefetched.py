@@ -0,0 +1,16 @@
+from .tts import TTS
+
+
+class PrefetchedTTS(TTS):
+    def __init__(self, speeches):
+        super().__init__()
+
+        self.__speeches = dict(speeches)
+
+    def text_to_speech(self, text: str):
+        """
+        return the speech synthesized in advance
+        """
+        assert text in self.__speeches, f"speech of {text!r} is not prefetched."
+
+        return self.__speeches[text]
@@ -3,9 +3,28 @@ import regex
 
 class TTS:
     WHITESPACE = regex.compile("\\s+")
+    # texts_to_speech synthesizes a batch in one request, rather than one
+    # text after another
+    batched = False
+
+    @staticmethod
+    def normalize(text: str):
+        return TTS.WHITESPACE.sub(" ", text).strip()
+
+    def identity(self):
+        """
+        engine and its settings which determine the synthesized speech
+        """
+        return (type(self).__name__, )
 
     def text_to_speech(text: str):
         """
         call Text-To-Speech
         """
         assert False
+
+    def texts_to_speech(self, texts):
+        """
+        call Text-To-Speech for each text
+        """
+        return [self.text_to_speech(text) for text in texts]
@@ -1,34 +1,98 @@
+import io
+import zipfile
+import regex
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 from .tts import TTS
 
 
 class VoiceVoxTTS(TTS):
-    def __init__(self, *, host="http://localhost:50021", speaker=2):
+    TITLE = regex.compile("<title>VOICEVOX ENGINE - Swagger UI</title>")
+    RUNNING = {}
+    batched = True
+
+    def __init__(self, *, host="http://localhost:50021", speaker=2,
+                 timeout=(3.05, 60), retries=3, pool_size=4):
         super().__init__()
 
         self.__host = host
         self.__speaker = speaker
+        self.__timeout = timeout
+
+        retry = Retry(total=retries, backoff_factor=0.5,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=frozenset(("GET", "POST")))
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.__session = requests.Session()
+        self.__session.mount("http://", adapter)
+        self.__session.mount("https://", adapter)
+
+    @classmethod
+    def is_running(cls, host="http://localhost:50021", timeout=3.05):
+        """
+        check whether VOICEVOX ENGINE is running on host, once per host
+        """
+        if host not in cls.RUNNING:
+            try:
+                res = requests.get("/".join([host, "docs"]), timeout=timeout)
+                cls.RUNNING[host] = (res.status_code == 200 and
+                                     bool(cls.TITLE.search(res.text)))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout):
+                cls.RUNNING[host] = False
+
+        return cls.RUNNING[host]
+
+    def identity(self):
+        return (type(self).__name__, self.__host, self.__speaker)
+
+    def _audio_query(self, text: str):
+        params = {
+            "text": TTS.normalize(text),
+            "speaker": self.__speaker,
+        }
+        query = self.__session.post("/".join([self.__host, "audio_query"]),
+                                    params=params,
+                                    timeout=self.__timeout)
+        query.raise_for_status()
+
+        return query.json()
 
     def text_to_speech(self, text: str):
         """
         call Text-To-Speech of VOICEVOX
         """
         params = {
-            "text": TTS.WHITESPACE.sub(text, " "),
             "speaker": self.__speaker,
         }
-        query = requests.post("/".join([self.__host, "audio_query"]),
-                              params=params)
+        wave = self.__session.post("/".join([self.__host, "synthesis"]),
+                                   params=params,
+                                   json=self._audio_query(text),
+                                   timeout=self.__timeout)
+        wave.raise_for_status()
+
+        return (wave.content, "wav")
+
+    def texts_to_speech(self, texts):
+        """
+        call Text-To-Speech of VOICEVOX with multi_synthesis in one request
+        """
+        if len(texts) <= 1:
+            return super().texts_to_speech(texts)
 
         params = {
             "speaker": self.__speaker,
         }
-        headers = {
-            "accept": "audio/wav",
-            "Content-Type": "application/json"
-        }
-        wave = requests.post("/".join([self.__host, "synthesis"]),
-                             params=params,
-                             json=query.json())
+        archive = self.__session.post(
+            "/".join([self.__host, "multi_synthesis"]),
+            params=params,
+            json=[self._audio_query(text) for text in texts],
+            timeout=self.__timeout)
+        archive.raise_for_status()
+
+        with zipfile.ZipFile(io.BytesIO(archive.content)) as f:
+            names = sorted(f.namelist())
+            assert len(names) == len(texts), "one wave per text is needed."
 
-        return (wave._content, "wav")
+            return [(f.read(name), "wav") for name in names]
@@ -1,14 +1,31 @@
 import io
+import os
+import copy
+import json
+import hashlib
+import collections
+import multiprocessing
+import weakref
 import numpy as np
 import platform
+import regex
+import xml.etree.ElementTree as ET
 from moviepy.editor import *
 from moviepy.audio.AudioClip import *
 from moviepy.video.VideoClip import *
 from PIL import ImageFont
 from .audio import Audio
+from .pool import MediaPool
 from .util import parse_time, ALL_ELEMENTS
+from .tts import PrefetchedTTS
+from .writer import FFmpegWriter, concat
+from .proxy import ProxyCache
 from .bbox import *
 
+# chunks are named after the output they belong to and their key, in the
+# container of the output
+CHUNK = regex.compile("([0-9a-f]{16})-[0-9a-f]{64}(\\.tmp)?\\.[^.]+")
+
 FONT_PATH = {
     "Windows": "C:/Windows/Fonts/meiryo.ttc",
     "Darwin": "/System/Library/Fonts/Courier.dfont",
@@ -18,7 +35,16 @@ FONT_PATH = {
 
 class Video:
     def __init__(self, *, fontPath=None, fontSize=52,
-                 colorBGR=(0, 0, 0, 255), audio=None):
+                 colorBGR=(0, 0, 0, 255), draft=1., audio=None, pool=None,
+                 proxies=None, profiler=None):
+        """
+        draft < 1 renders at draft times the size from downscaled proxies of
+        movies and images cached in proxies, with every pixel of the
+        document mapped accordingly.
+
+        profiler records each element built and rendered in this process;
+        frames of worker processes are not recorded.
+        """
         super().__init__()
         if not fontPath:
             pf = platform.system()
@@ -27,15 +53,66 @@ class Video:
             else:
                 assert False, "fontPath is not specified."
 
-        self.__fontPIL = ImageFont.truetype(fontPath, fontSize)
+        assert 0 < draft <= 1, "0 < draft <= 1 is needed."
+
+        self.__options = {
+            "fontPath": fontPath,
+            "fontSize": fontSize,
+            "colorBGR": colorBGR,
+            "draft": draft,
+        }
+        self.__draft = draft
+        self.__fontPIL = ImageFont.truetype(
+            fontPath, max(round(fontSize * draft), 1))
         self.__colorBGR = colorBGR
-        self.__audio = audio or Audio()
+        self.__texts = TextCache()
+        self.__boxes = {}
+        self.__durations = None
+        self.__pool = pool or MediaPool()
+        self.__audio = audio or Audio(pool=self.__pool, profiler=profiler)
+        self.__proxies = proxies or (ProxyCache() if draft < 1 else None)
+        self.__profiler = profiler
+        if profiler:
+            profiler.observe("text", self.__texts)
+            profiler.observe("proxy", self.__proxies)
+
+    def _pixels(self, value):
+        return round(int(value) * self.__draft)
+
+    def _workers(self, elem):
+        # what worker processes need besides the options to build the same
+        # video tree, after build(elem); proxies are found in the same
+        # directory
+        return {
+            "proxies": self.__proxies and self.__proxies.options(),
+            "durations": self._durations(elem),
+        }
+
+    def _source(self, src, kind):
+        # the audio is always taken from the original src
+        if self.__draft == 1:
+            return src
+        elif kind == "movie":
+            return self.__proxies.movie(src, self.__draft)
+        else:
+            return self.__proxies.image(src, self.__draft)
+
+    def _audio(self, elem):
+        # None while only the video tree is built
+        if self.__durations is not None:
+            return None
+        return self.__audio._build_any(elem)
+
+    def _duration(self, elem, audio):
+        if audio is None:
+            return self.__durations[elem]
+        return audio.duration_seconds
 
     def _build_audio(self, elem):
         assert len(elem) == 0, "no child is needed."
 
-        audio = self.__audio.build(elem)
-        video = BoundingBox(1, 1, audio.duration_seconds)
+        audio = self._audio(elem)
+        video = BoundingBox(1, 1, self._duration(elem, audio))
 
         return (video, audio)
 
@@ -47,7 +124,8 @@ class Video:
         else:
             assert False, "src file is needed."
 
-        return (MovieBB(src), self.__audio._build_any(elem))
+        return (MovieBB(self._source(src, "movie"), pool=self.__pool),
+                self._audio(elem))
 
     def _build_image(self, elem):
         assert len(elem) == 0, "no child is needed."
@@ -62,7 +140,9 @@ class Video:
         else:
             duration = 0
 
-        return (ImageBB(duration, src), self.__audio._build_any(elem))
+        return (ImageBB(duration, self._source(src, "image"),
+                        pool=self.__pool),
+                self._audio(elem))
 
     def _build_speak(self, elem):
         text = elem.text or ""
@@ -76,12 +156,13 @@ class Video:
             else:
                 assert False, "child with sub-tag is needed."
 
-        audio = self.__audio._build_any(elem)
+        audio = self._audio(elem)
         video = TextBB(
-            audio.duration_seconds,
+            self._duration(elem, audio),
             text,
             self.__fontPIL,
-            self.__colorBGR)
+            self.__colorBGR,
+            cache=self.__texts)
 
         return (video, audio)
 
@@ -93,11 +174,11 @@ class Video:
         w0, h0, d0 = video.boundings()
 
         if "width" in elem.attrib:
-            width = int(elem.attrib["width"])
+            width = self._pixels(elem.attrib["width"])
         else:
             width = w0
         if "height" in elem.attrib:
-            height = int(elem.attrib["height"])
+            height = self._pixels(elem.attrib["height"])
         else:
             height = h0
         if "duration" in elem.attrib:
@@ -123,7 +204,7 @@ class Video:
                 max(height - h0, 0),
                 max(duration - d0, 0))
 
-        return (video, self.__audio._build_any(elem))
+        return (video, self._audio(elem))
 
     def _build_crop(self, elem):
         assert len(elem) == 1, "only 1 child is needed."
@@ -133,12 +214,12 @@ class Video:
         width, height, duration = video.boundings()
 
         if "x0" in elem.attrib:
-            x0 = int(elem.attrib["x0"])
+            x0 = self._pixels(elem.attrib["x0"])
             assert 0 <= x0, "0 <= x0 is needed."
         else:
             x0 = 0
         if "y0" in elem.attrib:
-            y0 = int(elem.attrib["y0"])
+            y0 = self._pixels(elem.attrib["y0"])
             assert 0 <= y0, "0 <= y0 is needed."
         else:
             y0 = 0
@@ -148,12 +229,12 @@ class Video:
         else:
             t0 = 0
         if "x1" in elem.attrib:
-            x1 = int(elem.attrib["x1"])
+            x1 = self._pixels(elem.attrib["x1"])
             assert x0 <= x1, "x0 <= x1 is needed."
         else:
             x1 = width
         if "y1" in elem.attrib:
-            y1 = int(elem.attrib["y1"])
+            y1 = self._pixels(elem.attrib["y1"])
             assert y0 <= y1, "y0 <= y1 is needed."
         else:
             y1 = height
@@ -166,7 +247,7 @@ class Video:
         if 0 < x0 or 0 < y0 or 0 < t0 or x1 < width or y1 < height or t1 < duration:
             video = CropBB(video, x0, y0, t0, x1, y1, t1)
 
-        return (video, self.__audio._build_any(elem))
+        return (video, self._audio(elem))
 
     def _build_margin(self, elem):
         assert len(elem) == 1, "only 1 child is needed."
@@ -175,11 +256,11 @@ class Video:
         (video, _) = self._build_any(elem[0])
 
         if "left" in elem.attrib:
-            left = int(elem.attrib["left"])
+            left = self._pixels(elem.attrib["left"])
         else:
             left = 0
         if "right" in elem.attrib:
-            right = int(elem.attrib["right"])
+            right = self._pixels(elem.attrib["right"])
             assert 0 <= right, "0 <= right is needed."
         else:
             right = 0
@@ -189,12 +270,12 @@ class Video:
         else:
             before = 0
         if "top" in elem.attrib:
-            top = int(elem.attrib["top"])
+            top = self._pixels(elem.attrib["top"])
             assert 0 <= top, "0 <= top is needed."
         else:
             top = 0
         if "bottom" in elem.attrib:
-            bottom = int(elem.attrib["bottom"])
+            bottom = self._pixels(elem.attrib["bottom"])
             assert 0 <= bottom, "0 <= bottom is needed."
         else:
             bottom = 0
@@ -207,7 +288,7 @@ class Video:
         if 0 < left or 0 < top or 0 < before or 0 < right or 0 < bottom or 0 < after:
             video = MarginBB(video, left, top, before, right, bottom, after)
 
-        return (video, self.__audio._build_any(elem))
+        return (video, self._audio(elem))
 
     def _build_scale(self, elem):
         assert len(elem) == 1, "only 1 child is needed."
@@ -221,11 +302,11 @@ class Video:
             assert 0 < fxy, "0 <= fxy is needed."
         else:
             if "width" in elem.attrib:
-                width = int(elem.attrib["width"])
+                width = self._pixels(elem.attrib["width"])
             else:
                 width = w0
             if "height" in elem.attrib:
-                height = int(elem.attrib["height"])
+                height = self._pixels(elem.attrib["height"])
             else:
                 height = h0
             fxy = min(width / w0, height / h0)
@@ -241,7 +322,7 @@ class Video:
         if fxy != 1 or ft != 1:
             video = ScaleBB(video, fxy, ft)
 
-        return (video, self.__audio._build_any(elem))
+        return (video, self._audio(elem))
 
     def _build_par(self, elem):
         bblst = []
@@ -252,7 +333,7 @@ class Video:
             (video, _) = self._build_any(child)
             bblst.append(video)
 
-        return (ParBB(bblst), self.__audio._build_any(elem))
+        return (ParBB(bblst), self._audio(elem))
 
     def _build_seq(self, elem):
         bblst = []
@@ -263,9 +344,15 @@ class Video:
             (video, _) = self._build_any(child)
             bblst.append(video)
 
-        return (SeqBB(bblst), self.__audio._build_any(elem))
+        return (SeqBB(bblst), self._audio(elem))
 
     def _build_any(self, elem):
+        (video, audio) = self._build_dummy(elem)
+        self.__boxes[elem] = video
+
+        return (video, audio)
+
+    def _build_dummy(self, elem):
         assert elem.tag in ALL_ELEMENTS, f"elem with {ALL_ELEMENTS}-tag is needed."
 
         if elem.tag == "audio":
@@ -292,23 +379,317 @@ class Video:
             assert False
 
     def build(self, elem):
-        return self._build_any(elem)
+        # bounding box of each element, kept until the next build
+        self.__boxes = {}
+        if self.__profiler:
+            self.__profiler.document(elem)
+        self.__audio.prefetch(elem)
+        (video, audio) = self._build_any(elem)
+        self.__audio.clear()
+
+        merged = {}
+        video = merge_crops(video, merged)
+        if self.__profiler:
+            # innermost elements first, so that a box passed through by its
+            # parent is recorded as the child's
+            for e in reversed(list(elem.iter())):
+                if e in self.__boxes:
+                    bb = self.__boxes[e]
+                    self.__profiler.watch(e, merged.get(bb, bb))
+
+        return (video, audio)
+
+    def _durations(self, elem):
+        # durations of the elements whose video lasts as long as their
+        # audio, after build(elem)
+        return [self.__boxes[e].boundings()[2] for e in _sounding(elem)]
+
+    def _build_video(self, elem, durations):
+        # the video tree alone for worker processes, with _durations() of
+        # the same document instead of its audio
+        self.__boxes = {}
+        self.__durations = dict(zip(_sounding(elem), durations))
+        (video, _) = self._build_any(elem)
+        self.__durations = None
+
+        return merge_crops(video)
+
+    def encode(self, elem, *, processes=1, fps=30, chunk_size=30):
+        """
+        processes > 1 renders the frames at fps in worker processes; on
+        platforms which spawn processes, call it under __main__ guard.
+        """
+        assert 0 < processes, "0 < processes is needed."
+        assert 0 < chunk_size, "0 < chunk_size is needed."
 
-    def encode(self, elem):
         (video, audio) = self.build(elem)
 
         (_, _, duration) = video.boundings()
 
+        # the same times as VideoClip.iter_frames
+        if 1 < processes:
+            frames = _render_parallel(ET.tostring(elem), self.__options,
+                                      self._workers(elem),
+                                      np.arange(0, duration, 1.0 / fps),
+                                      processes, chunk_size)
+        else:
+            frames = None
+
         def make_frame(t):
+            # frames come in the order of write_videofile; the first frame
+            # for the size is rendered here.
+            if frames and frames[0][0] == t:
+                return frames.popleft()[1][:, :, ::-1]
+            if frames and t != 0:
+                frames.terminate()
+                assert False, "write_videofile needs the fps of encode."
             return video.image(t)[:, :, 2::-1]
 
         clip = VideoClip(make_frame, duration=duration)
-        # WORK_AROUND: MoviePy seem to have bugs to calculate the duration of
-        # monoral audio
-        audio = audio.set_channels(2)
-        array = np.frombuffer(audio.raw_data,
-                              dtype=np.int16).reshape(-1,
-                                                      audio.channels) / 65535.
-        clip.audio = AudioArrayClip(array, fps=audio.frame_rate)
+        if frames is not None:
+            # workers stop once the clip is closed or collected, even if it
+            # is never written
+            clip.close = weakref.finalize(clip, frames.terminate)
+
+        def make_audio(t):
+            # only the samples of the requested chunk are evaluated
+            # t is a multiple of 1 / frame_rate but for rounding errors
+            index = np.rint(np.atleast_1d(t) * audio.frame_rate).astype(
+                np.int64)
+            lo = index.min()
+            # full scale is 1, the same gain as write(); MoviePy saturates
+            samples = audio.read(lo, index.max() - lo + 1)[index - lo]
+            return samples if np.ndim(t) else samples[0]
+
+        clip.audio = AudioClip(make_audio, duration=audio.duration_seconds,
+                               fps=audio.frame_rate)
 
         return clip
+
+    def _segments(self, elem, times, fps, options):
+        """
+        (key, first frame, last frame + 1) of each part of the timeline
+        which is rendered independently
+        """
+        path = _find_seq(elem)
+        # every chunk has the size of the whole frame, and the children of
+        # seq are laid out in its box
+        sizes = [list(self.__boxes[elem].boundings()[:2])]
+        if path is None:
+            # nothing to split; the whole is one segment
+            children = []
+            starts = [0.]
+            context = elem
+        else:
+            seq = elem
+            for i in path:
+                seq = seq[i]
+            children = list(seq)
+            starts = self.__boxes[seq].starts
+            sizes.append(list(self.__boxes[seq].boundings()[:2]))
+            # the rest of the document, which every segment depends on
+            context = copy.deepcopy(elem)
+            node = context
+            for i in path:
+                node = node[i]
+            node[:] = []
+
+        base = [self.__audio.key(context), self.__options, fps,
+                sorted(options.items()), sizes]
+
+        # the same child as SeqBB._index, or after the end of seq
+        index = np.searchsorted(starts, times, side="right") - 1
+        bounds = np.searchsorted(index, np.arange(len(children) + 2))
+
+        segments = []
+        for (i, (lo, hi)) in enumerate(zip(bounds, bounds[1:])):
+            if lo < hi:
+                ident = base + [self.__audio.key(children[i])
+                                if i < len(children) else None,
+                                int(lo), int(hi)]
+                key = hashlib.sha256(json.dumps(
+                    ident, ensure_ascii=False).encode()).hexdigest()
+                segments.append((key, int(lo), int(hi)))
+
+        return segments
+
+    def write(self, elem, path, *, fps=30, processes=1, chunk_size=30,
+              workdir=None, **options):
+        """
+        render elem into path by piping frames to ffmpeg without MoviePy;
+        options such as codec, preset and threads are for FFmpegWriter.
+
+        with workdir, each child of the top-level seq-tag is encoded into
+        its own chunk there, and only chunks whose subtree, position or
+        context changed are rendered again. chunks are keyed by their frames
+        in the whole timeline, so a change of duration, as of an edited
+        speak-tag, renders every later chunk again, and a change of the size
+        of seq renders them all.
+        """
+        assert 0 < processes, "0 < processes is needed."
+        assert 0 < chunk_size, "0 < chunk_size is needed."
+
+        (video, audio) = self.build(elem)
+
+        (width, height, duration) = video.boundings()
+        times = np.arange(0, duration, 1.0 / fps)
+
+        if workdir is None:
+            segments = [(None, 0, len(times))]
+        else:
+            os.makedirs(workdir, exist_ok=True)
+            prefix = hashlib.sha256(
+                os.path.abspath(path).encode()).hexdigest()[:16]
+            ext = os.path.splitext(path)[1]
+            assert ext, "path with an extension is needed for workdir."
+            segments = [
+                (os.path.join(workdir, f"{prefix}-{key}{ext}"), lo, hi)
+                for (key, lo, hi) in self._segments(elem, times, fps, options)]
+        dirty = [(chunk, lo, hi) for (chunk, lo, hi) in segments
+                 if chunk is None or not os.path.exists(chunk)]
+
+        if 1 < processes and dirty:
+            frames = _render_parallel(
+                ET.tostring(elem), self.__options, self._workers(elem),
+                np.concatenate([times[lo:hi] for (_, lo, hi) in dirty]),
+                processes, chunk_size)
+        else:
+            frames = None
+
+        try:
+            for (chunk, lo, hi) in dirty:
+                if chunk is None:
+                    target = path
+                else:
+                    # renamed when it is complete, so a chunk is never partial
+                    (name, ext) = os.path.splitext(chunk)
+                    target = name + ".tmp" + ext
+                with FFmpegWriter(target, width, height, fps,
+                                  audio=audio if chunk is None else None,
+                                  **options) as writer:
+                    for t in times[lo:hi]:
+                        writer.write(frames.popleft()[1] if frames
+                                     else video.image(t))
+                if chunk is not None:
+                    os.replace(target, chunk)
+        finally:
+            if frames is not None:
+                frames.terminate()
+
+        if workdir is not None:
+            chunks = [chunk for (chunk, _, _) in segments]
+            concat(chunks, path, audio=audio,
+                   **{key: options[key] for key in
+                      ("audio_codec", "audio_fps", "ffmpeg")
+                      if key in options})
+
+            # chunks of older versions of this output are not needed any
+            # more; those of the other outputs in workdir are kept
+            for entry in os.scandir(workdir):
+                if (match := CHUNK.fullmatch(entry.name)) and \
+                        match.group(1) == prefix and entry.path not in chunks:
+                    os.remove(entry.path)
+
+
+def _sounding(elem):
+    # elements whose video lasts as long as their audio, in document order
+    return [e for e in elem.iter() if e.tag in ("audio", "speak")]
+
+
+def _find_seq(elem):
+    # child indices to the seq-tag whose children start at the same times
+    # as in the whole document
+    if elem.tag == "seq":
+        return []
+    elif elem.tag == "media" and "duration" not in elem.attrib:
+        children = elem
+    elif elem.tag == "par":
+        children = elem
+    else:
+        return None
+
+    for (i, child) in enumerate(children):
+        if (path := _find_seq(child)) is not None:
+            return [i] + path
+    return None
+
+
+_WORKER = None
+
+
+def _init_worker(xml, options, workers):
+    global _WORKER
+
+    # the audio is never built; a TTS is given so that none is looked for
+    proxies = workers["proxies"] and ProxyCache(**workers["proxies"])
+    video = Video(**options, audio=Audio(tts=PrefetchedTTS({})),
+                  proxies=proxies)
+    _WORKER = video._build_video(ET.fromstring(xml), workers["durations"])
+
+
+def _render_chunk(times):
+    return [(t, np.ascontiguousarray(_WORKER.image(t)[:, :, :3]))
+            for t in times]
+
+
+class _Frames:
+    """
+    frames rendered by workers, chunks of which are requested in order
+    within a bounded window
+    """
+
+    def __init__(self, pool, chunks, window):
+        self.__pool = pool
+        self.__chunks = iter(chunks)
+        self.__pending = collections.deque()
+        self.__frames = collections.deque()
+
+        for _ in range(window):
+            self._submit()
+
+    def _submit(self):
+        if (chunk := next(self.__chunks, None)) is not None:
+            self.__pending.append(
+                self.__pool.apply_async(_render_chunk, (chunk, )))
+
+    def _fill(self):
+        while not self.__frames and self.__pending:
+            self.__frames.extend(self.__pending.popleft().get())
+            self._submit()
+
+    def __bool__(self):
+        self._fill()
+        return bool(self.__frames)
+
+    def __getitem__(self, i):
+        self._fill()
+        return self.__frames[i]
+
+    def popleft(self):
+        self._fill()
+        frame = self.__frames.popleft()
+        if not self.__frames and not self.__pending:
+            self.close()
+
+        return frame
+
+    def close(self):
+        self.__pool.close()
+        self.__pool.join()
+
+    def terminate(self):
+        # also stops the workers rendering chunks nobody will take
+        self.__pending.clear()
+        self.__frames.clear()
+        self.__pool.terminate()
+        self.__pool.join()
+
+
+def _render_parallel(xml, options, workers, times, processes, chunk_size):
+    chunks = [times[i:i + chunk_size]
+              for i in range(0, len(times), chunk_size)]
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(xml, options, workers))
+
+    return _Frames(pool, chunks, 2 * processes)
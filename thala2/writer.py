@@ -0,0 +1,127 @@
+import os
+import subprocess
+import tempfile
+import numpy as np
+from moviepy.config import get_setting
+
+SAMPLE_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}
+
+
+def _audio_input(audio, audio_codec, audio_fps):
+    # raw samples are read from a file, since pipes other than stdin
+    # are not portable
+    if audio is None:
+        return ([], None)
+
+    assert audio.sample_width in SAMPLE_FORMATS, \
+        f"sample_width in {tuple(SAMPLE_FORMATS)} is needed."
+
+    (fd, temp) = tempfile.mkstemp(suffix=".pcm")
+    with os.fdopen(fd, "wb") as f:
+        for block in audio.raw_blocks():
+            f.write(block)
+
+    return (["-f", SAMPLE_FORMATS[audio.sample_width],
+             "-ar", str(audio.frame_rate),
+             "-ac", str(audio.channels), "-i", temp,
+             "-map", "0:v", "-map", "1:a", "-c:a", audio_codec,
+             "-ar", str(audio_fps)], temp)
+
+
+def concat(paths, path, *, audio=None, audio_codec="aac", audio_fps=44100,
+           ffmpeg=None):
+    """
+    join encoded video chunks into path by stream copy, and encode audio
+    over the whole of them at once
+    """
+    (fd, listing) = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        for chunk in paths:
+            chunk = os.path.abspath(chunk).replace("'", "'\\''")
+            f.write(f"file '{chunk}'\n")
+
+    command = [ffmpeg or get_setting("FFMPEG_BINARY"), "-y",
+               "-loglevel", "error",
+               "-f", "concat", "-safe", "0", "-i", listing]
+    (args, temp) = _audio_input(audio, audio_codec, audio_fps)
+    command += args + ["-c:v", "copy", path]
+
+    try:
+        process = subprocess.run(command, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+    finally:
+        os.remove(listing)
+        if temp:
+            os.remove(temp)
+
+    assert process.returncode == 0, \
+        f"ffmpeg failed: {process.stderr.decode(errors='replace')}"
+
+
+class FFmpegWriter:
+    def __init__(self, path, width, height, fps, *, audio=None,
+                 codec="libx264", preset="medium", threads=0,
+                 audio_codec="aac", audio_fps=44100, ffmpeg=None):
+        super().__init__()
+
+        self.width = width
+        self.height = height
+        self.frames = 0
+        self.buffer = np.empty([height, width, 3], dtype=np.uint8)
+
+        command = [ffmpeg or get_setting("FFMPEG_BINARY"), "-y",
+                   "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "bgr24",
+                   "-s", f"{width}x{height}", "-r", str(fps), "-i", "-"]
+
+        (args, self.__temp) = _audio_input(audio, audio_codec, audio_fps)
+        command += args
+
+        command += ["-c:v", codec, "-preset", preset,
+                    "-threads", str(threads)]
+        if codec == "libx264" and width % 2 == 0 and height % 2 == 0:
+            command += ["-pix_fmt", "yuv420p"]
+        command += [path]
+
+        self.__process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                          stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, image):
+        """
+        write BGR or BGRA image as a packed bgr24 frame
+        """
+        assert image.shape[:2] == (self.height, self.width), \
+            f"image of {self.width}x{self.height} is needed."
+
+        np.copyto(self.buffer, image[:, :, :3])
+        try:
+            self.__process.stdin.write(self.buffer.data)
+        except BrokenPipeError:
+            self.close()
+        self.frames += 1
+
+    def close(self):
+        if self.__process is None:
+            return
+
+        process = self.__process
+        self.__process = None
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = process.stderr.read().decode(errors="replace")
+        process.wait()
+
+        if self.__temp:
+            os.remove(self.__temp)
+            self.__temp = None
+
+        assert process.returncode == 0, f"ffmpeg failed: {error}"